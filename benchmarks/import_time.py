@@ -0,0 +1,52 @@
+"""Measure the time it takes a fresh interpreter to import parts of easy_oauth.
+
+Run with: python benchmarks/import_time.py [--runs 10]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+STATEMENTS = {
+    "bare": "import easy_oauth",
+    "capabilities": "from easy_oauth import CapabilitySet",
+    "manager": "from easy_oauth import OAuthManager",
+    "install": (
+        "from easy_oauth import OAuthManager; from starlette.applications import Starlette;"
+        " OAuthManager(server_metadata_url='http://localhost').install(Starlette())"
+    ),
+}
+
+
+def import_time(statement):
+    """Cumulative import time in seconds, as reported by -X importtime."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    total = 0
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line.split("|")
+            # Only count top-level imports, which include their children
+            if cumulative.strip().isdigit() and not name.startswith("  "):
+                total += int(cumulative)
+    return total / 1e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    print(f"{'statement':<14} {'min ms':>8} {'median ms':>10}")
+    for label, statement in STATEMENTS.items():
+        times = [import_time(statement) for _ in range(args.runs)]
+        print(f"{label:<14} {min(times) * 1000:>8.1f} {statistics.median(times) * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,23 @@
-from .cap import Capability, CapabilitySet
-from .manager import OAuthManager
+import importlib
+
+# Imported on first access, so that e.g. CapabilitySet can be used without
+# paying for the web and OAuth dependencies of OAuthManager
+_lazy = {
+    "Capability": ".cap",
+    "CapabilitySet": ".cap",
+    "OAuthManager": ".manager",
+}
 
 __all__ = ["Capability", "CapabilitySet", "OAuthManager"]
+
+
+def __getattr__(name):
+    if name not in _lazy:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_lazy[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted({*globals(), *__all__})
@@ -0,0 +1,123 @@
+import asyncio
+import json
+from abc import ABC, abstractmethod
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+
+
+@dataclass
+class Audit:
+    # JSONL file the records are appended to
+    file: Path
+
+    # Size in bytes beyond which the file is rotated to file.1, file.2, etc.
+    max_bytes: int = 10_000_000
+
+    # Number of rotated files to keep
+    backups: int = 5
+
+    # Maximum number of records waiting to be written, beyond which new records are dropped
+    queue_size: int = 10_000
+
+    # Maximum number of records given to the sink at once
+    batch_size: int = 100
+
+
+class AuditSink(ABC):
+    """Destination of audit records.
+
+    Subclass this and implement write() to send the records elsewhere, e.g. to a
+    database or a log collector, then set the manager's audit_sink attribute.
+    """
+
+    @abstractmethod
+    async def write(self, records: list[dict]):
+        """Write a batch of records. Exceptions are counted as failures, not retried."""
+
+
+class JSONLSink(AuditSink):
+    """Append records to a JSONL file, rotating it when it gets too large."""
+
+    def __init__(self, path: Path, max_bytes: int = 10_000_000, backups: int = 5):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    def rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if (src := self.path.with_name(f"{self.path.name}.{i}")).exists():
+                src.replace(self.path.with_name(f"{self.path.name}.{i + 1}"))
+        if self.backups:
+            self.path.replace(self.path.with_name(f"{self.path.name}.1"))
+        else:
+            self.path.unlink()
+
+    def write_sync(self, records):
+        data = "".join(json.dumps(record) + "\n" for record in records)
+        if self.path.exists() and self.path.stat().st_size + len(data) > self.max_bytes:
+            self.rotate()
+        with open(self.path, "a") as f:
+            f.write(data)
+
+    async def write(self, records):
+        # File I/O happens in a thread, so that requests are not held up by the disk
+        await asyncio.to_thread(self.write_sync, records)
+
+
+class AuditLog:
+    """Queue of audit records, written to a sink in batches by a background task.
+
+    record() never waits: if queue_size records are already waiting, the new
+    record is dropped and counted in the metrics instead.
+    """
+
+    def __init__(self, sink: AuditSink, queue_size: int = 10_000, batch_size: int = 100):
+        self.sink = sink
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.pending = deque()
+        self.task = None
+        self.metrics = {
+            # Records accepted into the queue
+            "enqueued": 0,
+            # Records given to the sink
+            "written": 0,
+            # Records dropped because the queue was full
+            "dropped": 0,
+            # Records lost because the sink raised an error
+            "failed": 0,
+            # Largest number of records that were waiting at the same time
+            "max_pending": 0,
+        }
+
+    def record(self, **fields):
+        """Queue a record, stamped with the current time. Returns False if it was dropped."""
+        if len(self.pending) >= self.queue_size:
+            self.metrics["dropped"] += 1
+            return False
+        self.pending.append({"timestamp": datetime.now(timezone.utc).isoformat(), **fields})
+        self.metrics["enqueued"] += 1
+        self.metrics["max_pending"] = max(self.metrics["max_pending"], len(self.pending))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.drain())
+        return True
+
+    async def drain(self):
+        # Records queued while a batch is being written go in the next batch
+        while self.pending:
+            batch = [
+                self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))
+            ]
+            try:
+                await self.sink.write(batch)
+                self.metrics["written"] += len(batch)
+            except Exception:
+                self.metrics["failed"] += len(batch)
+
+    async def flush(self):
+        """Wait until all the queued records are written."""
+        if self.task is not None and not self.task.done():
+            await self.task
+        await self.drain()
@@ -0,0 +1,21 @@
+from collections import OrderedDict
+
+
+class LRUCache(OrderedDict):
+    """Dictionary that holds at most maxsize entries, evicting the least recently used."""
+
+    def __init__(self, maxsize=1024):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key, default=None):
+        if key in self:
+            self.move_to_end(key)
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
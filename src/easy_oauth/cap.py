@@ -1,3 +1,6 @@
+import hashlib
+import json
+import secrets
 from dataclasses import dataclass, field
 from functools import cached_property
 from pathlib import Path
@@ -6,6 +9,15 @@ from serieux import deserialize
 from serieux.features.filebacked import DefaultFactory, FileBacked
 from serieux.features.registered import Registry
 
+from .patterns import EmailPatterns, is_pattern
+from .tracing import span
+
+# Prefix of the API keys issued by CapabilitySet
+API_KEY_PREFIX = "eoak_"
+
+# Prefix of the pseudo-email under which an API key's capabilities are checked
+API_KEY_PRINCIPAL = "apikey:"
+
 
 @dataclass(eq=False)
 class Capability:
@@ -29,6 +41,9 @@ class CapabilitySet:
     user_overrides: dict[str, list[str]] = field(default_factory=dict)
     default_capabilities: list[str] = field(default_factory=list)
     guest_capabilities: list[str] = field(default_factory=list)
+    api_key_file: Path = None
+    group_file: Path = None
+    resource_file: Path = None
 
     # [serieux: ignore]
     registry: Registry = None
@@ -36,6 +51,16 @@ class CapabilitySet:
     # [serieux: ignore]
     captype: type = None
 
+    # Incremented every time the user, group or resource file is saved, so that
+    # what is derived from the capabilities can be cached until they change
+    # [serieux: ignore]
+    generation: int = 0
+
+    # Size, modification time and inode of the API key file when it was last read,
+    # to notice when another process changes it
+    # [serieux: ignore]
+    api_key_file_stat: tuple = None
+
     def __post_init__(self):
         self.registry = Registry()
         for name in self.graph:
@@ -47,25 +72,315 @@ class CapabilitySet:
                 "admin", Capability("admin", set(self.registry.registry.values()))
             )
         self.captype = Capability @ self.registry
-        self._user_overrides = deserialize(dict[str, set[self.captype]], self.user_overrides)
-        self._default_capabilities = deserialize(set[self.captype], self.default_capabilities)
-        self._guest_capabilities = deserialize(set[self.captype], self.guest_capabilities)
+        # The deserializers below are built lazily, but unknown capabilities must
+        # still make the configuration fail when it is loaded
+        known = self.registry.registry.keys()
+        for attr, names in {
+            "_user_overrides": [n for caps in self.user_overrides.values() for n in caps],
+            "_default_capabilities": self.default_capabilities,
+            "_guest_capabilities": self.guest_capabilities,
+        }.items():
+            if not known >= set(names):
+                # Let the deserializer report the unknown names
+                getattr(self, attr)
 
     def __getitem__(self, item):
         return self.registry.registry[item]
 
+    # The deserializers for these are only built when a capability is first checked
+
+    @cached_property
+    def _user_overrides(self):
+        return deserialize(dict[str, set[self.captype]], self.user_overrides)
+
+    @cached_property
+    def _default_capabilities(self):
+        return deserialize(set[self.captype], self.default_capabilities)
+
+    @cached_property
+    def _guest_capabilities(self):
+        return deserialize(set[self.captype], self.guest_capabilities)
+
     @cached_property
     def db(self):
+        with span("load", file=str(self.user_file)):
+            return deserialize(
+                FileBacked[dict[str, set[self.captype]] @ DefaultFactory(dict)],
+                self.user_file,
+            )
+
+    @cached_property
+    def patterns(self):
+        """Grants by email pattern (e.g. *@example.com) in the user file and overrides."""
+        return EmailPatterns(
+            (email, caps)
+            for source in (self.db.value, self._user_overrides)
+            for email, caps in source.items()
+            if is_pattern(email)
+        )
+
+    def changed(self, *derived):
+        """Bump the generation and drop the cached properties derived from what changed."""
+        self.generation += 1
+        for name in ("fingerprint", *derived):
+            self.__dict__.pop(name, None)
+
+    @cached_property
+    def fingerprint(self):
+        """Digest of the graph and of everything that grants capabilities to users.
+
+        Unlike the generation, it is the same in every process that has the same
+        configuration and files, so it can tag what is derived from the
+        capabilities outside of this process, e.g. in sessions. It also changes
+        whenever the bit layout of capability_bits does.
+        """
+
+        def names(caps):
+            return sorted(map(str, caps))
+
+        state = {
+            "layout": sorted(self.registry.registry),
+            "graph": self.graph,
+            "overrides": self.user_overrides,
+            "defaults": self.default_capabilities,
+            "guests": self.guest_capabilities,
+            "users": {email: names(caps) for email, caps in self.db.value.items()},
+            "groups": {email: names(caps) for email, caps in self.group_index.items()},
+            "resources": sorted(
+                [email, resource, names(caps)]
+                for (email, resource), caps in self.resource_index.items()
+            ),
+        }
+        return hashlib.sha256(json.dumps(state, sort_keys=True).encode()).hexdigest()[:32]
+
+    def save(self):
+        """Save the user file after changing db.value."""
+        with span("save", file=str(self.user_file)):
+            self.db.save()
+        self.changed("patterns")
+
+    @cached_property
+    def group_type(self):
+        @dataclass
+        class Group:
+            capabilities: set[self.captype] = field(default_factory=set)
+            members: set[str] = field(default_factory=set)
+
+        return Group
+
+    @cached_property
+    def groups(self):
         return deserialize(
-            FileBacked[dict[str, set[self.captype]] @ DefaultFactory(dict)],
-            self.user_file,
+            FileBacked[dict[str, self.group_type] @ DefaultFactory(dict)],
+            self.group_file,
         )
 
-    def check(self, email, cap):
+    @cached_property
+    def group_index(self):
+        """Map each member of a group to the capabilities of all its groups."""
+        index = {}
+        if self.group_file is not None:
+            for group in self.groups.value.values():
+                for email in group.members:
+                    index.setdefault(email, set()).update(group.capabilities)
+        return index
+
+    def save_groups(self):
+        """Save the group file after changing groups.value."""
+        with span("save", file=str(self.group_file)):
+            self.groups.save()
+        self.changed("group_index")
+
+    @cached_property
+    def resources(self):
+        return deserialize(
+            FileBacked[dict[str, dict[str, set[self.captype]]] @ DefaultFactory(dict)],
+            self.resource_file,
+        )
+
+    @cached_property
+    def resource_index(self):
+        """Map (email, resource) to the capabilities granted to email on resource."""
+        if self.resource_file is None:
+            return {}
+        return {
+            (email, resource.strip("/")): caps
+            for resource, grants in self.resources.value.items()
+            for email, caps in grants.items()
+        }
+
+    def save_resources(self):
+        """Save the resource file after changing resources.value."""
+        with span("save", file=str(self.resource_file)):
+            self.resources.save()
+        self.changed("resource_index")
+
+    def resource_capabilities(self, email, resource):
+        """Capabilities granted to email on resource or any of its parents.
+
+        Resources are paths, so that a grant on project/1 also applies to
+        project/1/file/2.
+        """
+        caps = set()
+        parts = resource.strip("/").split("/")
+        for i in range(len(parts), 0, -1):
+            caps.update(self.resource_index.get((email, "/".join(parts[:i])), ()))
+        return caps
+
+    @cached_property
+    def api_key_type(self):
+        @dataclass
+        class ApiKey:
+            # SHA-256 digest of the key, the key itself is never stored
+            digest: str
+            capabilities: set[self.captype]
+
+        return ApiKey
+
+    def _api_key_file_stat(self):
+        try:
+            st = Path(self.api_key_file).stat()
+        except FileNotFoundError:
+            return None
+        return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def sync_api_keys(self):
+        """Read the API key file again if it changed since it was last read.
+
+        Keys may be issued or deleted by other workers sharing the file, and a
+        deleted key must stop working everywhere.
+        """
+        if (stat := self._api_key_file_stat()) != self.api_key_file_stat:
+            self.__dict__.pop("_api_keys", None)
+            self.__dict__.pop("api_key_index", None)
+            self.api_key_file_stat = stat
+
+    @cached_property
+    def _api_keys(self):
+        return deserialize(
+            FileBacked[dict[str, self.api_key_type] @ DefaultFactory(dict)],
+            self.api_key_file,
+        )
+
+    @property
+    def api_keys(self):
+        self.sync_api_keys()
+        return self._api_keys
+
+    @cached_property
+    def api_key_index(self):
+        return {key.digest: name for name, key in self.api_keys.value.items()}
+
+    def _save_api_keys(self):
+        self._api_keys.save()
+        # Our own changes do not need to be read again
+        self.api_key_file_stat = self._api_key_file_stat()
+
+    def issue_api_key(self, name, capabilities):
+        """Create an API key with the given capabilities and return it."""
+        key = API_KEY_PREFIX + secrets.token_urlsafe(32)
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        self.api_keys.value[name] = self.api_key_type(digest, set(capabilities))
+        self._save_api_keys()
+        self.api_key_index[digest] = name
+        return key
+
+    def delete_api_key(self, name):
+        key = self.api_keys.value.pop(name)
+        self._save_api_keys()
+        del self.api_key_index[key.digest]
+
+    def api_key_name(self, key):
+        """Return the name of an API key, or None if the key is not valid."""
+        if self.api_key_file is None:
+            return None
+        self.sync_api_keys()
+        return self.api_key_index.get(hashlib.sha256(key.encode()).hexdigest(), None)
+
+    def granted(self, email, resource=None):
+        """Capabilities given to email directly, not including the ones they imply."""
         if email is None:
             # Guest user (not authenticated)
-            return cap in Capability(implies=self._guest_capabilities)
+            return self._guest_capabilities
+
+        if self.api_key_file is not None and email.startswith(API_KEY_PRINCIPAL):
+            # API keys only have the capabilities they were issued with
+            key = self.api_keys.value.get(email.removeprefix(API_KEY_PRINCIPAL), None)
+            return set() if key is None else key.capabilities
 
         caps = self.db.value.get(email, set())
         overrides = self._user_overrides.get(email, set())
-        return cap in Capability(implies={*caps, *overrides, *self._default_capabilities})
+        patterns = self.patterns.match(email)
+        groups = self.group_index.get(email, set())
+        scoped = self.resource_capabilities(email, resource) if resource else set()
+        return {*caps, *overrides, *patterns, *groups, *scoped, *self._default_capabilities}
+
+    def effective(self, email, resource=None):
+        """All the capabilities of email, including the ones they imply."""
+        result = set()
+        stack = list(self.granted(email, resource))
+        while stack:
+            if (cap := stack.pop()) not in result:
+                result.add(cap)
+                stack.extend(cap.implies)
+        return result
+
+    def preload(self):
+        """Load the files and build the indexes that are otherwise built on the first check."""
+        names = [
+            "capability_bits",
+            "_user_overrides",
+            "_default_capabilities",
+            "_guest_capabilities",
+            "patterns",
+            "group_index",
+            "resource_index",
+            "fingerprint",
+        ]
+        if self.api_key_file is not None:
+            names.append("api_key_index")
+        for name in names:
+            getattr(self, name)
+        return self
+
+    @cached_property
+    def capability_bits(self):
+        """Bit assigned to each named capability, to encode sets of them as integers."""
+        return {self[name]: 1 << i for i, name in enumerate(sorted(self.registry.registry))}
+
+    def encode(self, caps):
+        return sum(self.capability_bits.get(cap, 0) for cap in caps)
+
+    def resolve(self, cap):
+        """Return the capability of this set that has the same name as cap.
+
+        cap may come from another capability set, e.g. one that was replaced by
+        OAuthManager.reload(). Capabilities are compared by identity, so checking
+        it against this set would otherwise always fail.
+        """
+        if cap is None or cap.name is None:
+            return cap
+        return self.registry.registry.get(cap.name, cap)
+
+    def check(self, email, cap, resource=None):
+        cap = self.resolve(cap)
+        with span("check", capability=cap.name, resource=resource) as sp:
+            allowed = cap in Capability(implies=self.granted(email, resource))
+            sp.set_attribute("easy_oauth.allowed", allowed)
+            return allowed
+
+    def check_many(self, email, caps, resource=None):
+        """Check many capabilities for one user, e.g. to filter a collection.
+
+        The user's capabilities are only resolved once. A requirement of None is
+        always satisfied. Returns a list of booleans, one per requirement.
+        """
+        effective = self.effective(email, resource)
+        return [cap is None or self.resolve(cap) in effective for cap in caps]
+
+    def check_users(self, emails, cap, resource=None):
+        """Check one capability for many users. Returns a list of booleans."""
+        cap = self.resolve(cap)
+        # Capabilities that imply cap, so that each user is a set intersection
+        implying = {c for c in self.registry.registry.values() if cap in c}
+        return [not implying.isdisjoint(self.granted(email, resource)) for email in emails]
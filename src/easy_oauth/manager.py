@@ -1,20 +1,69 @@
+import asyncio
+import hashlib
+import json
+import math
 import secrets
+import time
+from contextlib import asynccontextmanager, contextmanager, nullcontext
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from functools import cached_property
+from pathlib import Path
 
-import httpx
-from authlib.integrations.starlette_client import OAuth
-from itsdangerous import BadData, URLSafeSerializer
 from serieux import deserialize, serialize
 from serieux.features.encrypt import Secret
 from starlette.exceptions import HTTPException
-from starlette.middleware.sessions import SessionMiddleware
 from starlette.requests import Request
-from starlette.responses import JSONResponse, PlainTextResponse, RedirectResponse
+from starlette.responses import JSONResponse, PlainTextResponse, RedirectResponse, Response
 
-from .cap import CapabilitySet
+from .audit import Audit, AuditLog, AuditSink, JSONLSink
+from .cache import LRUCache
+from .cap import API_KEY_PREFIX, API_KEY_PRINCIPAL, CapabilitySet
+from .ratelimit import MemoryRateLimiter, RateLimiter, RateLimits
+from .revocation import RevocationList, token_digest
 from .structs import OpenIDConfiguration, Payload, UserInfo
+from .timing import ServerTimingMiddleware, timed_session_middleware, timer
+from .tracing import span, use_opentelemetry
+
+
+@dataclass
+class RefreshAhead:
+    # Refresh cached tokens in the background this many seconds before they expire
+    window: float = 300
+
+    # Maximum number of background refreshes running at the same time
+    max_concurrency: int = 8
+
+
+@dataclass
+class NegativeCache:
+    # Seconds during which a token rejected by the provider is refused outright
+    ttl: float = 60
+
+    # Each new rejection of the same token doubles the ttl, up to this many seconds
+    max_ttl: float = 3600
+
+    # Maximum number of rejected tokens to remember
+    max_size: int = 10_000
+
+
+@dataclass
+class UserinfoCache:
+    # Seconds during which the userinfo of a user is reused without asking the provider
+    ttl: float = 3600
+
+    # Maximum number of users whose userinfo is cached
+    max_size: int = 10_000
+
+
+@dataclass
+class CapabilitiesConfig:
+    capabilities: CapabilitySet = field(default_factory=lambda: CapabilitySet({}))
+
+    class SerieuxConfig:
+        # Only the capabilities are read when reloading, the rest of the
+        # manager's configuration (and its secrets) is ignored
+        allow_extras = True
 
 
 @dataclass(kw_only=True)
@@ -27,27 +76,143 @@ class OAuthManager:
     force_user: UserInfo = None
     capabilities: CapabilitySet = field(default_factory=lambda: CapabilitySet({}))
     prefix: str = ""
+    refresh_ahead: RefreshAhead = None
+    negative_cache: NegativeCache = field(default_factory=NegativeCache)
+    revocation_file: Path = None
+    rate_limits: RateLimits = None
+
+    # Keep the resolved capabilities of users in their session, until the
+    # capability set's fingerprint changes
+    session_capabilities: bool = False
+
+    # Fill in UserInfo with the provider's userinfo endpoint, cached per user
+    userinfo: UserinfoCache = None
+
+    # File where the provider's metadata is saved, to be reused by other workers
+    metadata_file: Path = None
+
+    # Seconds after which the saved provider metadata is fetched again
+    metadata_max_age: float = 86400
+
+    # Log changes to capabilities made through the /manage_capabilities/* routes
+    audit: Audit = None
+
+    # Configuration file from which the capabilities are reloaded on SIGHUP or
+    # through /manage_capabilities/reload, usually the file the manager was read from
+    config_file: Path = None
+
+    # Report the time spent decoding the session, verifying tokens, refreshing
+    # them with the provider and checking capabilities in a Server-Timing header
+    server_timing: bool = False
+
+    # Trace authentication and capability checks with OpenTelemetry
+    # (requires the tracing extra, i.e. opentelemetry-api)
+    tracing: bool = False
 
     # [serieux: ignore]
     token_cache: dict = field(default_factory=dict)
 
+    # [serieux: ignore]
+    refresh_tasks: dict = field(default_factory=dict)
+
+    # [serieux: ignore]
+    rate_limiter: RateLimiter = None
+
+    # Destination of the audit log, instead of audit.file
+    # [serieux: ignore]
+    audit_sink: AuditSink = None
+
+    # httpx transport for the requests made to the OAuth provider (used for testing)
+    # [serieux: ignore]
+    transport: object = None
+
     def __post_init__(self):
+        self.rejected_tokens = LRUCache(self.negative_cache.max_size)
+        self.revoked_tokens = RevocationList(self.revocation_file)
+        self.userinfo_cache = LRUCache(self.userinfo.max_size if self.userinfo else 0)
+        self.audit_log = None
+        self.reload_tasks = set()
+        # Serialized list responses, for each generation of the capabilities
+        self.list_cache = LRUCache(1024)
+        if self.audit_sink is not None:
+            self.audit_log = AuditLog(self.audit_sink)
+        if self.audit is not None:
+            sink = self.audit_sink or JSONLSink(
+                self.audit.file, self.audit.max_bytes, self.audit.backups
+            )
+            self.audit_log = AuditLog(sink, self.audit.queue_size, self.audit.batch_size)
+        if self.tracing:  # pragma: no cover
+            use_opentelemetry()
+        if self.rate_limiter is None and self.rate_limits:
+            self.rate_limiter = MemoryRateLimiter(self.rate_limits.max_keys)
         self.user_management_capability = self.capabilities.registry.registry.get(
             "user_management", None
         )
 
+    @cached_property
+    def provider_metadata(self):
+        """Discovery document and JWKS of the provider, fetched once and shared with authlib."""
+        path = self.metadata_file
+        if path is not None and path.exists():
+            metadata = json.loads(path.read_text())
+            if (
+                metadata.get("_url") == self.server_metadata_url
+                and time.time() - metadata["_loaded_at"] < self.metadata_max_age
+            ):
+                return metadata
+
+        import httpx
+
+        with httpx.Client(transport=self.transport) as client:
+            response = client.get(self.server_metadata_url)
+            response.raise_for_status()
+            metadata = response.json()
+            if jwks_uri := metadata.get("jwks_uri"):
+                response = client.get(jwks_uri)
+                response.raise_for_status()
+                metadata["jwks"] = response.json()
+        # authlib does not fetch the metadata again if _loaded_at is set
+        metadata["_loaded_at"] = time.time()
+        metadata["_url"] = self.server_metadata_url
+
+        if path is not None:
+            # Write then rename, so that other workers never read a partial file
+            tmp = path.with_name(f"{path.name}.{secrets.token_hex(4)}.tmp")
+            tmp.write_text(json.dumps(metadata))
+            tmp.replace(path)
+        return metadata
+
     @cached_property
     def server_metadata(self):
-        return deserialize(OpenIDConfiguration, self.server_metadata_url)
+        return deserialize(OpenIDConfiguration, self.provider_metadata)
+
+    async def get_server_metadata(self):
+        """Return server_metadata, fetching it in a thread so as not to block the event loop."""
+        if "server_metadata" not in self.__dict__:
+            await asyncio.to_thread(getattr, self, "server_metadata")
+        return self.server_metadata
 
     @cached_property
     def secrets_serializer(self):
+        from itsdangerous import URLSafeSerializer
+
         return URLSafeSerializer(self.secret_key)
 
     ###########
     # Helpers #
     ###########
 
+    def http_client(self):
+        import httpx
+
+        return httpx.AsyncClient(transport=self.transport)
+
+    def set_transport(self, transport):
+        """Route all requests to the OAuth provider through the given httpx transport."""
+        self.transport = transport
+        if oauth := getattr(self, "oauth", None):
+            oauth.client_kwargs["transport"] = transport
+
     def ensure_user_manager(self, email):
         if self.user_management_capability is None or not self.capabilities.check(
             email, self.user_management_capability
@@ -57,25 +222,75 @@ class OAuthManager:
                 detail=f"{self.user_management_capability} capability is required",
             )
 
-    async def get_user(self, request: Request):
-        if self.force_user:
-            return serialize(UserInfo, self.force_user)
+    def bearer_token(self, request: Request):
         if auth := request.headers.get("Authorization"):
             match auth.split("Bearer "):
-                case ("", rtoken):
-                    try:
-                        rtoken = self.secrets_serializer.loads(rtoken)
-                    except BadData:
-                        raise HTTPException(status_code=401, detail="Malformed authorization")
-                    if user := await self.user_from_refresh_token(rtoken):
-                        user = serialize(UserInfo, user)
-                        request.session["user"] = user
-                        return user
-                    else:  # pragma: no cover
-                        raise HTTPException(status_code=401, detail="Invalid user")
+                case ("", token):
+                    return token
                 case _:  # pragma: no cover
                     raise HTTPException(status_code=401, detail="Malformed authorization")
-        return request.session.get("user")
+        return None
+
+    def decrypt_token(self, token, status_code=401):
+        from itsdangerous import BadData
+
+        try:
+            return self.secrets_serializer.loads(token)
+        except BadData:
+            raise HTTPException(status_code=status_code, detail="Malformed authorization")
+
+    async def rate_limit(self, family, key):
+        if self.rate_limits and (limit := getattr(self.rate_limits, family)):
+            if wait := await self.rate_limiter.acquire(f"{family}:{key}", limit):
+                raise HTTPException(
+                    status_code=429,
+                    detail="Too many requests",
+                    headers={"Retry-After": str(math.ceil(wait))},
+                )
+
+    def rate_limited(self, family, route):
+        if not (self.rate_limits and getattr(self.rate_limits, family)):
+            return route
+
+        async def limited_route(request):
+            if family == "manage":
+                key = await self.get_email(request)
+            else:
+                key = None
+            if key is None:
+                key = request.client.host
+            await self.rate_limit(family, key)
+            return await route(request)
+
+        return limited_route
+
+    async def get_user(self, request: Request):
+        with span("get_user") as sp:
+            if self.force_user:
+                sp.set_attribute("easy_oauth.auth", "force_user")
+                return serialize(UserInfo, self.force_user)
+            if (token := self.bearer_token(request)) is not None:
+                if token.startswith(API_KEY_PREFIX):
+                    sp.set_attribute("easy_oauth.auth", "api_key")
+                    with timer("token"):
+                        name = self.capabilities.api_key_name(token)
+                    if name is None:
+                        raise HTTPException(status_code=401, detail="Invalid API key")
+                    return serialize(UserInfo, UserInfo(email=f"{API_KEY_PRINCIPAL}{name}"))
+                sp.set_attribute("easy_oauth.auth", "bearer")
+                with timer("token"):
+                    rtoken = self.decrypt_token(token)
+                    revoked = rtoken in self.revoked_tokens
+                if revoked:
+                    raise HTTPException(status_code=401, detail="Revoked token")
+                if user := await self.user_from_refresh_token(rtoken):
+                    user = serialize(UserInfo, user)
+                    request.session["user"] = user
+                    return user
+                else:
+                    raise HTTPException(status_code=401, detail="Invalid user")
+            sp.set_attribute("easy_oauth.auth", "session")
+            return request.session.get("user")
 
     async def get_email(self, request: Request):
         user = await self.get_user(request)
@@ -92,60 +307,220 @@ class OAuthManager:
         else:
             return user["email"]
 
-    def get_email_capability(self, cap=None, redirect=False):
+    def check_capability(self, request, email, cap, resource=None):
+        """Check that email has cap, using the capabilities stored in the session if enabled."""
+        caps = self.capabilities
+        cap = caps.resolve(cap)
+        if (
+            not self.session_capabilities
+            or email is None
+            or resource
+            or cap not in caps.capability_bits
+        ):
+            return caps.check(email, cap, resource=resource)
+        # The fingerprint, unlike the generation, does not depend on the process,
+        # and it covers the layout of the bits in the mask
+        key = [email, caps.fingerprint]
+        stored = request.session.get("capabilities", None)
+        if stored is None or stored[:2] != key:
+            # Stored as hex because the session is JSON and the mask may be large
+            stored = [*key, format(caps.encode(caps.effective(email)), "x")]
+            request.session["capabilities"] = stored
+        return bool(int(stored[2], 16) & caps.capability_bits[cap])
+
+    def get_email_capability(self, cap=None, redirect=False, resource=None):
+        """Dependency that returns the user's email if they have the capability.
+
+        resource is a template such as "project/{project_id}", filled in with the
+        request's path parameters, to also accept users who were granted the
+        capability on that resource only.
+        """
         if isinstance(cap, str):
-            cap = deserialize(self.capabilities.captype, cap)
+            # Fail early if the capability does not exist, but keep the name, since
+            # reload() may replace the capability set after the route is defined.
+            # Capability objects are resolved by name when they are checked.
+            deserialize(self.capabilities.captype, cap)
 
         async def get(request: Request):
             if redirect:
                 email = await self.ensure_email(request)
             else:
                 email = await self.get_email(request)
-            if cap is None or self.capabilities.check(email, cap):
+            res = resource and resource.format(**request.path_params)
+            with timer("caps"):
+                required = (
+                    self.capabilities.registry.registry.get(cap) if isinstance(cap, str) else cap
+                )
+                # A capability that was removed by a reload is granted to nobody
+                allowed = cap is None or (
+                    required is not None
+                    and self.check_capability(request, email, required, resource=res)
+                )
+            if allowed:
                 yield email
             elif email is None:
                 raise HTTPException(status_code=401, detail="Authentication required")
+            elif res:
+                raise HTTPException(status_code=403, detail=f"{cap} capability required on {res}")
             else:
                 raise HTTPException(status_code=403, detail=f"{cap} capability required")
 
         return get
 
     async def user_from_refresh_token(self, rtoken):
-        match self.token_cache.get(rtoken, None):
-            case (user, _, expiry) if expiry < datetime.now():
-                return await self.refresh_token(rtoken)
-            case (user, _, expiry):
+        now = datetime.now()
+        with span("user_from_refresh_token") as sp:
+            match self.token_cache.get(rtoken, None):
+                case (user, _, expiry) if expiry < now:
+                    sp.set_attribute("easy_oauth.cache", "expired")
+                    return await self.refresh_token(rtoken)
+                case (user, _, expiry):
+                    sp.set_attribute("easy_oauth.cache", "hit")
+                    if self.refresh_ahead and expiry - now < timedelta(
+                        seconds=self.refresh_ahead.window
+                    ):
+                        self.schedule_refresh(rtoken)
+                    return user
+                case None:
+                    sp.set_attribute("easy_oauth.cache", "miss")
+                    return await self.refresh_token(rtoken)
+
+    def schedule_refresh(self, rtoken):
+        """Refresh a token in the background, unless too many refreshes are in flight."""
+        if (
+            rtoken in self.refresh_tasks
+            or len(self.refresh_tasks) >= self.refresh_ahead.max_concurrency
+        ):
+            return
+
+        def done(task):
+            del self.refresh_tasks[rtoken]
+            if not task.cancelled():
+                # Failures are not fatal: the entry will be refreshed inline on expiry
+                task.exception()
+
+        task = asyncio.create_task(self.refresh_token(rtoken))
+        self.refresh_tasks[rtoken] = task
+        task.add_done_callback(done)
+
+    def reject_token(self, rtoken, now):
+        """Refuse a token the provider rejected, with exponential backoff."""
+        self.token_cache.pop(rtoken, None)
+        _, failures = self.rejected_tokens.get(rtoken, (None, 0))
+        ttl = min(self.negative_cache.ttl * 2**failures, self.negative_cache.max_ttl)
+        self.rejected_tokens[rtoken] = (now + timedelta(seconds=ttl), failures + 1)
+
+    async def refresh_token(self, rtoken):
+        now = datetime.now()
+        with span("refresh_token") as sp, timer("refresh"):
+            match self.rejected_tokens.get(rtoken, None):
+                case (until, _) if until > now:
+                    sp.set_attribute("easy_oauth.outcome", "negative_cache")
+                    return None
+
+            await self.rate_limit("refresh", token_digest(rtoken).hex())
+
+            data = {
+                "client_id": self.client_id,
+                "client_secret": self.client_secret,
+                "refresh_token": rtoken,
+                "grant_type": "refresh_token",
+            }
+            metadata = await self.get_server_metadata()
+            async with self.http_client() as client:
+                response = await client.post(metadata.token_endpoint, data=data)
+                if response.status_code in (400, 401):
+                    # The provider refuses this token (revoked, expired, invalid_grant...)
+                    sp.set_attribute("easy_oauth.outcome", "rejected")
+                    self.reject_token(rtoken, now)
+                    return None
+                response.raise_for_status()
+                self.rejected_tokens.pop(rtoken, None)
+                data = response.json()
+                atoken = data.get("access_token")
+                user = await self.enrich_user(deserialize(UserInfo, data.get("id_token")), atoken)
+                expiry = datetime.now() + timedelta(seconds=data.get("expires_in", 3600))
+                self.token_cache[rtoken] = (user, atoken, expiry)
+                sp.set_attribute("easy_oauth.outcome", "refreshed")
                 return user
+
+    async def enrich_user(self, user, atoken):
+        """Add the information from the provider's userinfo endpoint to user, if enabled.
+
+        Responses are cached per sub for userinfo.ttl seconds, after which they are
+        revalidated with If-None-Match if the provider gave an ETag.
+        """
+        if (
+            not self.userinfo
+            or not atoken
+            or not (endpoint := (await self.get_server_metadata()).userinfo_endpoint)
+        ):
+            return user
+        now = datetime.now()
+        match self.userinfo_cache.get(user.sub, None):
+            case (until, _, data) if until > now:
+                return user.enrich(data)
+            case (_, etag, data):
+                pass
             case None:
-                return await self.refresh_token(rtoken)
+                etag = data = None
 
-    async def refresh_token(self, rtoken):
-        data = {
-            "client_id": self.client_id,
-            "client_secret": self.client_secret,
-            "refresh_token": rtoken,
-            "grant_type": "refresh_token",
-        }
-        async with httpx.AsyncClient() as client:
-            response = await client.post(self.server_metadata.token_endpoint, data=data)
-            response.raise_for_status()
+        headers = {"Authorization": f"Bearer {atoken}"}
+        if etag:
+            headers["If-None-Match"] = etag
+        async with self.http_client() as client:
+            response = await client.get(endpoint, headers=headers)
+        if response.status_code == 304 and data is not None:
+            pass
+        elif response.is_success:
             data = response.json()
-            atoken = data.get("access_token")
-            user = deserialize(UserInfo, data.get("id_token"))
-            expiry = datetime.now() + timedelta(seconds=data.get("expires_in", 3600))
-            self.token_cache[rtoken] = (user, atoken, expiry)
-            return user
+            etag = response.headers.get("ETag", None)
+        else:
+            # Userinfo is optional, so errors only mean that it will be missing
+            return user if data is None else user.enrich(data)
+        self.userinfo_cache[user.sub] = (now + timedelta(seconds=self.userinfo.ttl), etag, data)
+        return user.enrich(data)
+
+    async def revoke_token(self, rtoken):
+        """Revoke a refresh token locally and with the provider."""
+        self.revoked_tokens.add(rtoken)
+        self.token_cache.pop(rtoken, None)
+        if endpoint := (await self.get_server_metadata()).revocation_endpoint:
+            data = {
+                "client_id": self.client_id,
+                "client_secret": self.client_secret,
+                "token": rtoken,
+                "token_type_hint": "refresh_token",
+            }
+            import httpx
+
+            try:
+                async with self.http_client() as client:
+                    response = await client.post(endpoint, data=data)
+            except httpx.HTTPError as exc:
+                raise HTTPException(
+                    status_code=502,
+                    detail=f"Could not reach the provider to revoke the token: {exc}",
+                )
+            # 4xx errors other than rate limits mean the token was already invalid
+            if response.status_code >= 500 or response.status_code == 429:
+                raise HTTPException(
+                    status_code=502,
+                    detail=f"The provider failed to revoke the token ({response.status_code})",
+                )
 
     async def assimilate_payload(self, request):
-        token = await self.oauth.authorize_access_token(request)
-        if "userinfo" not in token and "id_token" in token:  # pragma: no cover
-            token["userinfo"] = token["id_token"]
-        payload = deserialize(Payload, token)
+        with span("assimilate_payload"):
+            token = await self.oauth.authorize_access_token(request)
+            if "userinfo" not in token and "id_token" in token:  # pragma: no cover
+                token["userinfo"] = token["id_token"]
+            payload = deserialize(Payload, token)
 
-        if payload.userinfo:
-            request.session["user"] = serialize(UserInfo, payload.userinfo)
-            request.session["access_token"] = payload.access_token
-            request.session["refresh_token"] = payload.refresh_token
+            if payload.userinfo:
+                user = await self.enrich_user(payload.userinfo, payload.access_token)
+                request.session["user"] = serialize(UserInfo, user)
+                request.session["access_token"] = payload.access_token
+                request.session["refresh_token"] = payload.refresh_token
 
     ##########
     # Routes #
@@ -164,6 +539,8 @@ class OAuthManager:
         params = {}
         if request.query_params.get("offline_token") == "true":
             params = {"access_type": "offline", "prompt": "consent"}
+        if login_hint := request.query_params.get("login_hint"):
+            params["login_hint"] = login_hint
         return await self.oauth.authorize_redirect(
             request,
             str(redirect_uri),
@@ -184,79 +561,348 @@ class OAuthManager:
 
         if not (rt := request.session.get("refresh_token")):
             if not state:
-                login_url = request.url_for("login")
-                return RedirectResponse(url=f"{login_url}?offline_token=true&redirect=token")
+                params = {"offline_token": "true", "redirect": "token"}
+                if login_hint := request.query_params.get("login_hint"):
+                    params["login_hint"] = login_hint
+                login_url = request.url_for("login").include_query_params(**params)
+                return RedirectResponse(url=str(login_url))
             else:  # pragma: no cover
                 return PlainTextResponse("Unauthorized", status_code=401)
 
         ert = self.secrets_serializer.dumps(rt)
         return JSONResponse({"refresh_token": ert})
 
+    async def route_revoke(self, request):
+        if self.force_user:
+            return JSONResponse({"status": "ok"})
+        body = await request.json() if await request.body() else {}
+        if ert := body.get("refresh_token"):
+            rtoken = self.decrypt_token(ert, status_code=400)
+        elif (token := self.bearer_token(request)) is not None:
+            rtoken = self.decrypt_token(token)
+            request.session.clear()
+        elif rtoken := request.session.get("refresh_token"):
+            request.session.clear()
+        else:
+            raise HTTPException(status_code=400, detail="No token to revoke")
+        await self.revoke_token(rtoken)
+        return JSONResponse({"status": "ok"})
+
     async def route_logout(self, request):
         request.session.clear()
         return RedirectResponse(url="/")
 
+    #############
+    # Reloading #
+    #############
+
+    def load_capabilities(self, source=None):
+        """Read the capabilities from the configuration and load all their files."""
+        config = deserialize(CapabilitiesConfig, source or self.config_file)
+        return config.capabilities.preload()
+
+    async def reload(self, source=None, actor=None):
+        """Replace the capabilities with the ones in the configuration.
+
+        The new capability set is built in a thread, so that requests keep being
+        served with the old one in the meantime, and then swapped in at once.
+        Token caches and sessions are kept, but the capabilities stored in
+        sessions are invalidated.
+        """
+        with span("reload"):
+            while True:
+                old = self.capabilities
+                generation = old.generation
+                new = await asyncio.to_thread(self.load_capabilities, source)
+                # Load again if the capabilities were changed in the meantime
+                if self.capabilities is old and old.generation == generation:
+                    break
+            # Sessions are keyed on the new set's fingerprint, the generation only
+            # invalidates what this process cached, e.g. the list responses
+            new.generation = generation + 1
+            self.capabilities = new
+            self.user_management_capability = new.registry.registry.get("user_management", None)
+        self.audit_record(actor=actor, action="reload", generation=new.generation)
+        return new
+
+    def reload_in_background(self):
+        def done(task):
+            self.reload_tasks.discard(task)
+            if not task.cancelled() and (exc := task.exception()):
+                # The old capabilities are kept if the configuration is invalid
+                self.audit_record(actor=None, action="reload", error=str(exc))
+
+        task = asyncio.create_task(self.reload())
+        self.reload_tasks.add(task)
+        task.add_done_callback(done)
+
+    @contextmanager
+    def handle_reload_signal(self):
+        """Reload the capabilities when the process receives SIGHUP, within the with block."""
+        import signal
+
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGHUP, self.reload_in_background)
+        except (ValueError, RuntimeError, NotImplementedError):  # pragma: no cover
+            # Signals can only be handled in the main thread, and not on Windows
+            yield
+            return
+        try:
+            yield
+        finally:
+            loop.remove_signal_handler(signal.SIGHUP)
+
     ##########################
     # User management routes #
     ##########################
 
-    def _get_user_capabilities(self, email):
-        db = self.capabilities.db
-        return serialize(set[self.capabilities.captype], db.value.get(email, set()))
+    def audit_record(self, **fields):
+        """Record a change in the audit log, if it is enabled."""
+        if self.audit_log is not None:
+            self.audit_log.record(**fields)
 
-    def _manage_cap_response(self, email):
-        return JSONResponse(
-            {
-                "status": "ok",
-                "email": email,
-                "capabilities": self._get_user_capabilities(email),
-            }
-        )
+    def _get_user_capabilities(self, email, resource=None):
+        if resource is None:
+            caps = self.capabilities.db.value.get(email, set())
+        else:
+            caps = self.capabilities.resource_index.get((email, resource.strip("/")), set())
+        return serialize(set[self.capabilities.captype], caps)
+
+    def _manage_cap_content(self, email, resource=None):
+        content = {
+            "status": "ok",
+            "email": email,
+            "capabilities": self._get_user_capabilities(email, resource),
+        }
+        if resource is not None:
+            content["resource"] = resource
+        return content
 
-    async def _manage_generic(self, request, reqcls):
+    def _manage_cap_response(self, email, resource=None):
+        return JSONResponse(self._manage_cap_content(email, resource))
+
+    def _cached_response(self, request, key, build):
+        """Respond with the content from build(), serialized once per generation.
+
+        The ETag is a digest of the body rather than the generation, since
+        workers count generations independently.
+        """
+        cache_key = (self.capabilities.generation, *key)
+        if (cached := self.list_cache.get(cache_key)) is None:
+            body = JSONResponse(build()).body
+            etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+            cached = self.list_cache[cache_key] = (body, etag)
+        body, etag = cached
+        if_none_match = request.headers.get("If-None-Match", "")
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if etag in tags or "*" in tags:
+            return Response(status_code=304, headers={"ETag": etag})
+        return Response(body, media_type="application/json", headers={"ETag": etag})
+
+    async def _manage_generic(self, request, reqcls, action):
         user = await self.get_email(request)
         self.ensure_user_manager(user)
 
         req = deserialize(reqcls, await request.json())
 
-        db = self.capabilities.db
-        req.apply(db.value)
-        db.save()
+        if req.resource is None:
+            target = self.capabilities.db.value
+        elif self.capabilities.resource_file is None:
+            raise HTTPException(status_code=400, detail="Resource capabilities are not enabled")
+        else:
+            target = self.capabilities.resources.value.setdefault(req.resource.strip("/"), {})
+        before = set(target.get(req.email, set()))
+        req.apply(target)
+        if req.resource is None:
+            self.capabilities.save()
+        else:
+            self.capabilities.save_resources()
+
+        captype = self.capabilities.captype
+        self.audit_record(
+            actor=user,
+            action=action,
+            target=req.email,
+            resource=req.resource,
+            before=serialize(set[captype], before),
+            after=serialize(set[captype], target.get(req.email, set())),
+        )
 
-        return self._manage_cap_response(req.email)
+        return self._manage_cap_response(req.email, req.resource)
 
     async def route_manage_capabilities_add(self, request):
         @dataclass
         class AddRequest:
             email: str
             capability: self.capabilities.captype
+            resource: str = None
 
             def apply(self, caps):
                 caps.setdefault(self.email, set()).add(self.capability)
 
-        return await self._manage_generic(request, AddRequest)
+        return await self._manage_generic(request, AddRequest, "add")
 
     async def route_manage_capabilities_remove(self, request):
         @dataclass
         class RemoveRequest:
             email: str
             capability: self.capabilities.captype
+            resource: str = None
 
             def apply(self, caps):
                 caps.setdefault(self.email, set()).discard(self.capability)
 
-        return await self._manage_generic(request, RemoveRequest)
+        return await self._manage_generic(request, RemoveRequest, "remove")
 
     async def route_manage_capabilities_set(self, request):
         @dataclass
         class SetRequest:
             email: str
             capabilities: set[self.capabilities.captype]
+            resource: str = None
 
             def apply(self, caps):
                 caps[self.email] = self.capabilities
 
-        return await self._manage_generic(request, SetRequest)
+        return await self._manage_generic(request, SetRequest, "set")
+
+    async def route_manage_api_keys_create(self, request):
+        user = await self.get_email(request)
+        self.ensure_user_manager(user)
+
+        @dataclass
+        class CreateRequest:
+            name: str
+            capabilities: set[self.capabilities.captype]
+
+        req = deserialize(CreateRequest, await request.json())
+        if req.name in self.capabilities.api_keys.value:
+            raise HTTPException(status_code=409, detail=f"API key {req.name!r} already exists")
+        key = self.capabilities.issue_api_key(req.name, req.capabilities)
+        capabilities = serialize(set[self.capabilities.captype], req.capabilities)
+        self.audit_record(
+            actor=user, action="create_api_key", target=req.name, before=None, after=capabilities
+        )
+        return JSONResponse(
+            {"status": "ok", "name": req.name, "key": key, "capabilities": capabilities}
+        )
+
+    async def route_manage_api_keys_delete(self, request):
+        user = await self.get_email(request)
+        self.ensure_user_manager(user)
+
+        @dataclass
+        class DeleteRequest:
+            name: str
+
+        req = deserialize(DeleteRequest, await request.json())
+        if req.name not in self.capabilities.api_keys.value:
+            raise HTTPException(status_code=404, detail=f"API key {req.name!r} does not exist")
+        before = self.capabilities.api_keys.value[req.name].capabilities
+        self.capabilities.delete_api_key(req.name)
+        self.audit_record(
+            actor=user,
+            action="delete_api_key",
+            target=req.name,
+            before=serialize(set[self.capabilities.captype], before),
+            after=None,
+        )
+        return JSONResponse({"status": "ok", "name": req.name})
+
+    async def route_manage_api_keys_list(self, request):
+        self.ensure_user_manager(await self.get_email(request))
+        api_keys = {
+            name: serialize(set[self.capabilities.captype], key.capabilities)
+            for name, key in self.capabilities.api_keys.value.items()
+        }
+        return JSONResponse({"status": "ok", "api_keys": api_keys})
+
+    def _serialize_group(self, group):
+        return {
+            "capabilities": serialize(set[self.capabilities.captype], group.capabilities),
+            "members": sorted(group.members),
+        }
+
+    async def _manage_group_generic(self, request, reqcls, action, create=False):
+        user = await self.get_email(request)
+        self.ensure_user_manager(user)
+
+        req = deserialize(reqcls, await request.json())
+
+        groups = self.capabilities.groups.value
+        if req.name in groups:
+            before = self._serialize_group(groups[req.name])
+        elif create:
+            before = None
+            groups[req.name] = self.capabilities.group_type()
+        else:
+            raise HTTPException(status_code=404, detail=f"Group {req.name!r} does not exist")
+        req.apply(groups[req.name])
+        self.capabilities.save_groups()
+
+        after = self._serialize_group(groups[req.name])
+        self.audit_record(actor=user, action=action, target=req.name, before=before, after=after)
+        return JSONResponse({"status": "ok", "name": req.name, **after})
+
+    async def route_manage_groups_set(self, request):
+        @dataclass
+        class SetRequest:
+            name: str
+            capabilities: set[self.capabilities.captype]
+
+            def apply(self, group):
+                group.capabilities = self.capabilities
+
+        return await self._manage_group_generic(request, SetRequest, "set_group", create=True)
+
+    async def route_manage_groups_add_member(self, request):
+        @dataclass
+        class AddMemberRequest:
+            name: str
+            email: str
+
+            def apply(self, group):
+                group.members.add(self.email)
+
+        return await self._manage_group_generic(request, AddMemberRequest, "add_member")
+
+    async def route_manage_groups_remove_member(self, request):
+        @dataclass
+        class RemoveMemberRequest:
+            name: str
+            email: str
+
+            def apply(self, group):
+                group.members.discard(self.email)
+
+        return await self._manage_group_generic(request, RemoveMemberRequest, "remove_member")
+
+    async def route_manage_groups_delete(self, request):
+        user = await self.get_email(request)
+        self.ensure_user_manager(user)
+
+        @dataclass
+        class DeleteRequest:
+            name: str
+
+        req = deserialize(DeleteRequest, await request.json())
+        if req.name not in self.capabilities.groups.value:
+            raise HTTPException(status_code=404, detail=f"Group {req.name!r} does not exist")
+        before = self._serialize_group(self.capabilities.groups.value.pop(req.name))
+        self.capabilities.save_groups()
+        self.audit_record(
+            actor=user, action="delete_group", target=req.name, before=before, after=None
+        )
+        return JSONResponse({"status": "ok", "name": req.name})
+
+    async def route_manage_groups_list(self, request):
+        self.ensure_user_manager(await self.get_email(request))
+        groups = {
+            name: self._serialize_group(group)
+            for name, group in self.capabilities.groups.value.items()
+        }
+        return JSONResponse({"status": "ok", "groups": groups})
 
     async def route_manage_capabilities_list_user(self, request):
         user = await self.get_email(request)
@@ -264,38 +910,90 @@ class OAuthManager:
         @dataclass
         class ListRequest:
             email: str = user
+            resource: str = None
 
         req = deserialize(ListRequest, dict(request.query_params))
 
         if req.email != user:
             self.ensure_user_manager(user)
 
-        return self._manage_cap_response(req.email)
+        return self._cached_response(
+            request,
+            ("list_user", req.email, req.resource),
+            lambda: self._manage_cap_content(req.email, req.resource),
+        )
+
+    async def route_manage_capabilities_reload(self, request):
+        from serieux.exc import SerieuxError
+        from yaml import YAMLError
+
+        user = await self.get_email(request)
+        self.ensure_user_manager(user)
+        try:
+            caps = await self.reload(actor=user)
+        # KeyError is raised for capabilities that the graph refers to but does not define
+        except (SerieuxError, YAMLError, OSError, KeyError) as exc:
+            raise HTTPException(status_code=400, detail=f"Could not reload capabilities: {exc}")
+        return JSONResponse({"status": "ok", "generation": caps.generation})
 
     async def route_manage_capabilities_list(self, request: Request):
         user = await self.get_email(request)
         self.ensure_user_manager(user)
 
-        users_capabilities = {}
-        for email in self.capabilities.db.value.keys():
-            users_capabilities[email] = self._get_user_capabilities(email)
+        def build():
+            users_capabilities = {}
+            for email in self.capabilities.db.value.keys():
+                users_capabilities[email] = self._get_user_capabilities(email)
+
+            graph = self.capabilities.graph.copy()
+            if self.capabilities.auto_admin:
+                graph.setdefault("admin", list(graph.keys()))
 
-        graph = self.capabilities.graph.copy()
-        if self.capabilities.auto_admin:
-            graph.setdefault("admin", list(graph.keys()))
+            return {"status": "ok", "users": users_capabilities, "graph": graph}
 
-        return JSONResponse({"status": "ok", "users": users_capabilities, "graph": graph})
+        return self._cached_response(request, ("list",), build)
 
     ##################
     # Install to app #
     ##################
 
+    def wrap_lifespan(self, app):
+        """Run the manager's startup and shutdown steps around the app's lifespan.
+
+        The router's lifespan context is wrapped rather than using on_startup and
+        on_shutdown, which Starlette ignores when the app has its own lifespan.
+        """
+        inner = app.router.lifespan_context
+
+        @asynccontextmanager
+        async def lifespan(app):
+            try:
+                with (
+                    self.handle_reload_signal() if self.config_file is not None else nullcontext()
+                ):
+                    async with inner(app) as state:
+                        yield state
+            finally:
+                if self.audit_log is not None:
+                    # Write the records that are still queued before exiting
+                    await self.audit_log.flush()
+
+        app.router.lifespan_context = lifespan
+
     def install(self, app):
+        from authlib.integrations.starlette_client import OAuth
+        from starlette.middleware.sessions import SessionMiddleware
+
         app.add_middleware(
-            SessionMiddleware,
+            timed_session_middleware(SessionMiddleware)
+            if self.server_timing
+            else SessionMiddleware,
             secret_key=self.secret_key,
             max_age=14 * 24 * 60 * 60,
         )
+        if self.server_timing:
+            # Added last so that it wraps the session middleware and sees its timings
+            app.add_middleware(ServerTimingMiddleware)
 
         oauth = OAuth()
         oauth.register(
@@ -303,37 +1001,91 @@ class OAuthManager:
             client_id=self.client_id,
             client_secret=self.client_secret,
             server_metadata_url=self.server_metadata_url,
-            client_kwargs=self.client_kwargs,
+            client_kwargs={**self.client_kwargs, "transport": self.transport},
         )
         self.oauth = getattr(oauth, "easy-oauth")
 
-        app.add_route(f"{self.prefix}/login", self.route_login, name="login")
+        async def load_server_metadata():
+            # Use the manager's copy of the metadata rather than fetching it again.
+            # authlib may still update its own copy, e.g. to refetch rotated keys.
+            if "_loaded_at" not in self.oauth.server_metadata:
+                await self.get_server_metadata()
+                self.oauth.server_metadata.update(self.provider_metadata)
+            return self.oauth.server_metadata
+
+        self.oauth.load_server_metadata = load_server_metadata
+
+        self.wrap_lifespan(app)
+        app.state.easy_oauth = self
+
+        app.add_route(
+            f"{self.prefix}/login", self.rate_limited("login", self.route_login), name="login"
+        )
         app.add_route(f"{self.prefix}/logout", self.route_logout)
-        app.add_route(f"{self.prefix}/auth", self.route_auth, name="auth")
-        app.add_route(f"{self.prefix}/token", self.route_token, name="token")
+        app.add_route(
+            f"{self.prefix}/auth", self.rate_limited("login", self.route_auth), name="auth"
+        )
+        app.add_route(
+            f"{self.prefix}/token", self.rate_limited("token", self.route_token), name="token"
+        )
+        app.add_route(f"{self.prefix}/revoke", self.route_revoke, methods=["POST"])
 
         if self.user_management_capability:
             app.add_route(
                 f"{self.prefix}/manage_capabilities/add",
-                self.route_manage_capabilities_add,
+                self.rate_limited("manage", self.route_manage_capabilities_add),
                 methods=["POST"],
             )
             app.add_route(
                 f"{self.prefix}/manage_capabilities/remove",
-                self.route_manage_capabilities_remove,
+                self.rate_limited("manage", self.route_manage_capabilities_remove),
                 methods=["POST"],
             )
             app.add_route(
                 f"{self.prefix}/manage_capabilities/set",
-                self.route_manage_capabilities_set,
+                self.rate_limited("manage", self.route_manage_capabilities_set),
                 methods=["POST"],
             )
+            if self.config_file is not None:
+                app.add_route(
+                    f"{self.prefix}/manage_capabilities/reload",
+                    self.rate_limited("manage", self.route_manage_capabilities_reload),
+                    methods=["POST"],
+                )
+            if self.capabilities.api_key_file:
+                app.add_route(
+                    f"{self.prefix}/manage_api_keys/create",
+                    self.rate_limited("manage", self.route_manage_api_keys_create),
+                    methods=["POST"],
+                )
+                app.add_route(
+                    f"{self.prefix}/manage_api_keys/delete",
+                    self.rate_limited("manage", self.route_manage_api_keys_delete),
+                    methods=["POST"],
+                )
+                app.add_route(
+                    f"{self.prefix}/manage_api_keys/list",
+                    self.rate_limited("manage", self.route_manage_api_keys_list),
+                )
+            if self.capabilities.group_file:
+                for action in ("set", "add_member", "remove_member", "delete"):
+                    app.add_route(
+                        f"{self.prefix}/manage_groups/{action}",
+                        self.rate_limited(
+                            "manage", getattr(self, f"route_manage_groups_{action}")
+                        ),
+                        methods=["POST"],
+                    )
+                app.add_route(
+                    f"{self.prefix}/manage_groups/list",
+                    self.rate_limited("manage", self.route_manage_groups_list),
+                )
 
         app.add_route(
             f"{self.prefix}/manage_capabilities/list_user",
-            self.route_manage_capabilities_list_user,
+            self.rate_limited("manage", self.route_manage_capabilities_list_user),
         )
         app.add_route(
             f"{self.prefix}/manage_capabilities/list",
-            self.route_manage_capabilities_list,
+            self.rate_limited("manage", self.route_manage_capabilities_list),
         )
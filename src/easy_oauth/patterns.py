@@ -0,0 +1,63 @@
+import re
+from fnmatch import translate
+
+
+def is_pattern(email):
+    return any(c in email for c in "*?[")
+
+
+class _Node:
+    __slots__ = ("children", "exact", "subdomains")
+
+    def __init__(self):
+        self.children = {}
+        self.exact = set()
+        self.subdomains = set()
+
+
+class EmailPatterns:
+    """Capabilities granted by email pattern, compiled for fast lookup.
+
+    * ``*@example.com`` matches every address at example.com
+    * ``*@*.example.com`` matches every address at a subdomain of example.com
+    * Any other pattern is a glob, e.g. ``admin-*@example.com``
+
+    Domain patterns are stored in a trie indexed by the labels of the domain in
+    reverse order, so a lookup takes one step per label of the email's domain no
+    matter how many domains have grants. Globs are tried one after the other.
+    Matching is case-insensitive.
+    """
+
+    def __init__(self, grants=()):
+        self.root = _Node()
+        self.globs = []
+        for pattern, caps in grants:
+            self.add(pattern, caps)
+
+    def add(self, pattern, caps):
+        pattern = pattern.lower()
+        local, _, domain = pattern.rpartition("@")
+        base = domain.removeprefix("*.")
+        if local == "*" and base and not is_pattern(base):
+            node = self.root
+            for label in reversed(base.split(".")):
+                node = node.children.setdefault(label, _Node())
+            (node.exact if base == domain else node.subdomains).update(caps)
+        else:
+            self.globs.append((re.compile(translate(pattern)), set(caps)))
+
+    def match(self, email):
+        """Return the capabilities granted to email by all matching patterns."""
+        email = email.lower()
+        result = set()
+        node = self.root
+        for label in reversed(email.rpartition("@")[2].split(".")):
+            result |= node.subdomains
+            if (node := node.children.get(label)) is None:
+                break
+        else:
+            result |= node.exact
+        for regex, caps in self.globs:
+            if regex.match(email):
+                result |= caps
+        return result
@@ -0,0 +1,66 @@
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+
+from .cache import LRUCache
+
+
+@dataclass
+class RateLimit:
+    # Number of requests allowed per second, on average
+    rate: float
+
+    # Number of requests that can be made in a burst
+    burst: int = 1
+
+
+@dataclass
+class RateLimits:
+    # /login and /auth, per IP address
+    login: RateLimit = None
+
+    # /token, per IP address
+    token: RateLimit = None
+
+    # Refreshes of Bearer tokens with the OAuth provider, per token
+    refresh: RateLimit = None
+
+    # /manage_* routes, per email (or per IP address for guests)
+    manage: RateLimit = None
+
+    # Maximum number of buckets kept by the in-memory rate limiter
+    max_keys: int = 100_000
+
+
+class RateLimiter(ABC):
+    """Token bucket rate limiter.
+
+    Subclass this and implement acquire() to share buckets between workers,
+    e.g. in Redis, then set the manager's rate_limiter attribute to an instance.
+    """
+
+    @abstractmethod
+    async def acquire(self, key: str, limit: RateLimit) -> float:
+        """Take a token from the bucket for key.
+
+        Returns 0 if the request is allowed, otherwise the number of seconds to
+        wait before a token becomes available.
+        """
+
+
+class MemoryRateLimiter(RateLimiter):
+    """Rate limiter that keeps its buckets in memory, for a single worker."""
+
+    def __init__(self, max_keys=100_000):
+        self.buckets = LRUCache(max_keys)
+
+    async def acquire(self, key, limit):
+        now = time.monotonic()
+        tokens, last = self.buckets.get(key, (limit.burst, now))
+        tokens = min(limit.burst, tokens + (now - last) * limit.rate)
+        if tokens >= 1:
+            self.buckets[key] = (tokens - 1, now)
+            return 0
+        else:
+            self.buckets[key] = (tokens, now)
+            return (1 - tokens) / limit.rate
@@ -0,0 +1,72 @@
+import hashlib
+import time
+from pathlib import Path
+
+
+def token_digest(token):
+    return hashlib.sha256(token.encode()).digest()
+
+
+class RevocationList:
+    """Set of revoked tokens, optionally shared between workers through a file.
+
+    Tokens are only stored as SHA-256 digests. The file is append-only, one hex
+    digest per line, and every worker reads the lines appended by the others at
+    most once every sync_interval seconds. A Bloom filter sits in front of the
+    exact set, so checking a token that was never revoked only costs a few bit
+    lookups.
+    """
+
+    def __init__(
+        self, path: Path | None = None, bits: int = 2**20, hashes: int = 4, sync_interval=1.0
+    ):
+        self.path = path and Path(path)
+        self.bits = bits
+        self.hashes = hashes
+        self.sync_interval = sync_interval
+        self.bloom = bytearray((bits + 7) // 8)
+        self.digests = set()
+        self.offset = 0
+        self.last_sync = None
+        self.sync()
+
+    def _positions(self, digest):
+        for i in range(self.hashes):
+            yield int.from_bytes(digest[4 * i : 4 * i + 4]) % self.bits
+
+    def _insert(self, digest):
+        for pos in self._positions(digest):
+            self.bloom[pos >> 3] |= 1 << (pos & 7)
+        self.digests.add(digest)
+
+    def sync(self):
+        """Read the revocations that other workers appended to the file."""
+        self.last_sync = time.monotonic()
+        if self.path is None or not self.path.exists():
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read()
+        # Leave out a trailing line that may still be in the process of being written
+        data = data[: data.rfind(b"\n") + 1]
+        self.offset += len(data)
+        for line in data.split():
+            self._insert(bytes.fromhex(line.decode()))
+
+    def add(self, token):
+        digest = token_digest(token)
+        self._insert(digest)
+        if self.path is not None:
+            with open(self.path, "ab") as f:
+                f.write(digest.hex().encode() + b"\n")
+
+    def __contains__(self, token):
+        if self.path is not None and time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+        digest = token_digest(token)
+        if all(self.bloom[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(digest)):
+            return digest in self.digests
+        return False
+
+    def __len__(self):
+        return len(self.digests)
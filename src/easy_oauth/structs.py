@@ -1,8 +1,7 @@
 import base64
 import json
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, fields, replace
 
-import httpx
 from serieux import deserialize
 
 
@@ -30,6 +29,8 @@ class OpenIDConfiguration(Base):
 
     @classmethod
     def serieux_from_string(cls, url):
+        import httpx
+
         resp = httpx.get(url)
         resp.raise_for_status()
         data = resp.json()
@@ -44,10 +45,36 @@ class UserInfo(Base):
     # The user's unique ID
     sub: str = None
 
+    # Optional profile information, from the id_token or the userinfo endpoint
+    email_verified: bool = None
+    name: str = None
+    given_name: str = None
+    family_name: str = None
+    picture: str = None
+    locale: str = None
+    hd: str = None
+
     def __post_init__(self):
         if self.sub is None:
             self.sub = self.email
 
+    @classmethod
+    def serieux_serialize(cls, obj, ctx, call_next):
+        # Leave out the profile fields the provider did not give, which would
+        # otherwise take space in every session cookie
+        return {k: v for k, v in call_next(cls, obj, ctx).items() if v is not None}
+
+    def enrich(self, data: dict):
+        """Fill in the missing fields from a userinfo response for the same user."""
+        if data.get("sub") != self.sub:
+            return self
+        missing = {
+            f.name: data[f.name]
+            for f in fields(self)
+            if getattr(self, f.name) is None and data.get(f.name) is not None
+        }
+        return replace(self, **missing) if missing else self
+
     @classmethod
     def serieux_from_string(cls, idtoken):
         parts = idtoken.split(".")
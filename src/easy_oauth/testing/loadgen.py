@@ -0,0 +1,202 @@
+"""Load generator for apps that use OAuthManager.
+
+Simulates a number of users sending a mix of session-cookie, Bearer, guest
+and capability-denied requests to an app, through AppTester and OAuthMock,
+and reports throughput and latency percentiles for each kind of request.
+
+Run with: easy-oauth-loadgen --app module:app --path /hello --requests 10000
+"""
+
+import asyncio
+import importlib
+import random
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+
+from serieux import deserialize, parse_cli
+
+from .utils import AppTester, OAuthMock
+
+KINDS = ("session", "bearer", "guest", "denied")
+
+
+@dataclass
+class LoadProfile:
+    # Number of simulated users
+    users: int = 10
+
+    # Total number of requests to send
+    requests: int = 1000
+
+    # Maximum number of requests in flight at the same time
+    concurrency: int = 50
+
+    # Route requested by users and guests
+    path: str = "/"
+
+    # Route that requires a capability the users do not have (required if denied > 0)
+    denied_path: str | None = None
+
+    # Relative frequency of each kind of request
+    session: float = 1
+    bearer: float = 1
+    guest: float = 1
+    denied: float = 0
+
+    # Emails of the simulated users, formatted with their index
+    email_format: str = "loadgen-{}@example.com"
+
+    # Seed for the random choice of requests
+    seed: int = None
+
+    def __post_init__(self):
+        if self.denied > 0 and self.denied_path is None:
+            raise ValueError("denied_path must be set to send denied requests")
+
+    def weights(self):
+        return {kind: getattr(self, kind) for kind in KINDS if getattr(self, kind) > 0}
+
+
+@dataclass
+class LoadReport:
+    # Wall time of the run, in seconds
+    duration: float
+
+    # Latencies in seconds, for each kind of request
+    latencies: dict[str, list[float]] = field(default_factory=dict)
+
+    # Number of responses per status code (0 for errors), for each kind of request
+    statuses: dict[str, Counter] = field(default_factory=dict)
+
+    @property
+    def total(self):
+        return sum(len(lats) for lats in self.latencies.values())
+
+    @property
+    def throughput(self):
+        return self.total / self.duration
+
+    def percentile(self, kind, p):
+        """Return the p-th percentile of the latencies of kind, or None if there are none."""
+        lats = sorted(self.latencies[kind])
+        if not lats:
+            return None
+        return lats[min(len(lats) - 1, int(len(lats) * p / 100))]
+
+    def summary(self):
+        lines = [
+            f"{self.total} requests in {self.duration:.2f}s ({self.throughput:.1f} req/s)",
+            f"{'kind':<8} {'count':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  statuses",
+        ]
+        for kind, lats in self.latencies.items():
+            # Kinds that were never picked by the plan have no latencies
+            p50, p95, p99 = (
+                "-" if (lat := self.percentile(kind, p)) is None else f"{lat * 1000:.2f}"
+                for p in (50, 95, 99)
+            )
+            statuses = ", ".join(f"{s}: {n}" for s, n in sorted(self.statuses[kind].items()))
+            lines.append(f"{kind:<8} {len(lats):>7} {p50:>8} {p95:>8} {p99:>8}  {statuses}")
+        return "\n".join(lines)
+
+
+class LoadGenerator:
+    def __init__(self, app: AppTester, profile: LoadProfile):
+        self.app = app
+        self.profile = profile
+        self.random = random.Random(profile.seed)
+
+    def plan(self):
+        weights = self.profile.weights()
+        return self.random.choices(list(weights), list(weights.values()), k=self.profile.requests)
+
+    def _login(self, email):
+        # Go through the OAuth flow once to get a session cookie for this user
+        prefix = getattr(self.app.manager, "prefix", "")
+        with self.app.http_client(follow_redirects=True) as client:
+            client.get(f"{self.app.base_url}{prefix}/login", params={"login_hint": email})
+            return dict(client.cookies)
+
+    async def run(self):
+        profile = self.profile
+        weights = profile.weights()
+        emails = [profile.email_format.format(i) for i in range(profile.users)]
+        tokens = {}
+        cookies = {}
+        for email in emails:
+            if {"bearer", "denied"} & set(weights):
+                tokens[email] = self.app.get_token(email)
+            if "session" in weights:
+                cookies[email] = self._login(email)
+
+        plan = self.plan()
+        report = LoadReport(
+            duration=0,
+            latencies={kind: [] for kind in weights},
+            statuses={kind: Counter() for kind in weights},
+        )
+
+        async with self.app.async_session(follow_redirects=False) as client:
+
+            async def send(kind):
+                email = self.random.choice(emails)
+                path = profile.path
+                headers = {}
+                if kind == "session":
+                    headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in cookies[email].items())
+                elif kind in ("bearer", "denied"):
+                    headers["Authorization"] = f"Bearer {tokens[email]}"
+                if kind == "denied":
+                    path = profile.denied_path
+                start = time.perf_counter()
+                try:
+                    response = await client.get(f"{self.app.base_url}{path}", headers=headers)
+                    status = response.status_code
+                except Exception:
+                    status = 0
+                report.latencies[kind].append(time.perf_counter() - start)
+                report.statuses[kind][status] += 1
+
+            async def worker():
+                while plan:
+                    await send(plan.pop())
+
+            start = time.perf_counter()
+            await asyncio.gather(*[worker() for _ in range(profile.concurrency)])
+            report.duration = time.perf_counter() - start
+
+        return report
+
+
+def run_load(app: AppTester, profile: LoadProfile) -> LoadReport:
+    """Send the requests described by profile to the app and report on them."""
+    return asyncio.run(LoadGenerator(app, profile).run())
+
+
+@dataclass
+class LoadCommand(LoadProfile):
+    # Import path of the ASGI app, as module:symbol
+    app: str = None
+
+    # Port of the OAuth mock, which must match the app's server_metadata_url
+    oauth_port: int = 29313
+
+    # Run the app and mock in-process rather than with real servers
+    inprocess: bool = True
+
+
+def load_app(path):
+    module, symbol = path.split(":")
+    return getattr(importlib.import_module(module), symbol)
+
+
+def main(argv=None):
+    command = deserialize(LoadCommand, parse_cli(LoadCommand, argv))
+    app = load_app(command.app)
+    with OAuthMock(port=command.oauth_port, inprocess=command.inprocess) as oauth_mock:
+        with AppTester(app, oauth_mock) as appt:
+            print(run_load(appt, command).summary())
+
+
+if __name__ == "__main__":
+    main()
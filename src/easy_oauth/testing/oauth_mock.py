@@ -9,54 +9,140 @@ Mock Google OAuth2 server for testing.
 This FastAPI server mocks Google's OAuth2 endpoints and always returns
 successful authentication responses.
 
-Run with: python tests/oauth_mock.py
+Run with: python -m easy_oauth.testing.oauth_mock [--workers N]
 Test with: curl -X POST http://localhost:8080/oauth2/token -d "grant_type=authorization_code&code=test"
 """
 
+import asyncio
 import base64
+import hashlib
 import json
+import os
+import random
 import time
 from datetime import datetime, timedelta
-from typing import Optional
+from pathlib import Path
+from typing import Literal, Optional
 from uuid import uuid4
 
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import padding, rsa
 from fastapi import FastAPI, Form, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel
+
+from ..cache import LRUCache
 
 # Configurable email for mock responses
 _mock_email = "test@example.com"
 
 app = FastAPI(title="Mock Google OAuth2 Server", version="1.0.0")
 
-# Generate RSA key pair for signing tokens
-_private_key = rsa.generate_private_key(
-    public_exponent=65537, key_size=2048, backend=default_backend()
-)
-_public_key = _private_key.public_key()
-
-# Export public key components for JWKS
-_public_numbers = _public_key.public_numbers()
-_modulus = (
-    base64.urlsafe_b64encode(
-        _public_numbers.n.to_bytes((_public_numbers.n.bit_length() + 7) // 8, "big")
-    )
-    .decode()
-    .rstrip("=")
-)
-_exponent = (
-    base64.urlsafe_b64encode(
-        _public_numbers.e.to_bytes((_public_numbers.e.bit_length() + 7) // 8, "big")
-    )
-    .decode()
-    .rstrip("=")
-)
+
+class MockSettings(BaseModel):
+    """Performance settings of the mock, read from MOCK_OAUTH_* environment variables."""
+
+    # PEM file holding the signing key, created if missing, so that every worker
+    # and every test session can share the same key
+    key_file: Optional[str] = None
+    # Size of the RSA key that is generated when there is no key file
+    key_size: int = 2048
+    # Maximum number of refresh tokens, auth codes and cached id_tokens kept in memory
+    store_size: int = 100_000
+    # Number of seconds during which a signed id_token is reused for the same identity
+    id_token_ttl: float = 0
+    # Accept tokens and codes issued by other workers, by decoding the identity they carry
+    stateless: bool = False
+
+    @classmethod
+    def from_env(cls, environ=os.environ):
+        return cls(
+            **{
+                name: value
+                for name in cls.model_fields
+                if (value := environ.get(f"MOCK_OAUTH_{name.upper()}")) is not None
+            }
+        )
+
+
+settings = MockSettings.from_env()
+
+AUTH_CODE_PREFIX = "mock_auth_code_"
+
+_signing_key = None
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def signing_key():
+    """Private key used to sign id_tokens, generated or loaded on first use."""
+    global _signing_key
+    if _signing_key is None:
+        key_file = settings.key_file and Path(settings.key_file)
+        if key_file and key_file.exists():
+            _signing_key = serialization.load_pem_private_key(key_file.read_bytes(), None)
+        else:
+            _signing_key = rsa.generate_private_key(
+                public_exponent=65537, key_size=settings.key_size
+            )
+            if key_file:
+                key_file.write_bytes(
+                    _signing_key.private_bytes(
+                        serialization.Encoding.PEM,
+                        serialization.PrivateFormat.PKCS8,
+                        serialization.NoEncryption(),
+                    )
+                )
+    return _signing_key
+
+
+def public_jwk() -> dict:
+    """Public part of the signing key, in JWK format."""
+    numbers = signing_key().public_key().public_numbers()
+    return {
+        "kty": "RSA",
+        "use": "sig",
+        "kid": "mock_key_id",
+        "n": _b64(numbers.n.to_bytes((numbers.n.bit_length() + 7) // 8, "big")),
+        "e": _b64(numbers.e.to_bytes((numbers.e.bit_length() + 7) // 8, "big")),
+        "alg": "RS256",
+    }
+
+
+def configure(**changes):
+    """Change the settings of the mock, resizing the stores and dropping stale keys."""
+    global settings, _signing_key
+    settings = settings.model_copy(update=changes)
+    if {"key_file", "key_size"} & set(changes):
+        _signing_key = None
+    for store in (
+        mock_token_store,
+        mock_auth_code_store,
+        mock_access_token_store,
+        _revoked_tokens,
+        _id_token_cache,
+    ):
+        store.maxsize = settings.store_size
+    if {"key_file", "key_size", "id_token_ttl"} & set(changes):
+        _id_token_cache.clear()
+    return settings
 
 
 def create_mock_id_token(email: str, sub: str, nonce: str, base_url: str, client_id: str) -> str:
-    """Create a JWT ID token with a real RS256 signature."""
+    """Create a JWT ID token with a real RS256 signature.
+
+    Tokens without a nonce are reused for settings.id_token_ttl seconds, so that
+    repeated refreshes for the same identity do not all pay for an RSA signature.
+    """
+    cache_key = (email, sub, base_url, client_id)
+    reuse = not nonce and settings.id_token_ttl > 0
+    if reuse and (cached := _id_token_cache.get(cache_key)):
+        token, issued_at = cached
+        if time.time() - issued_at < settings.id_token_ttl:
+            return token
+
     header = {"alg": "RS256", "typ": "JWT", "kid": "mock_key_id"}
     payload = {
         "iss": base_url,
@@ -93,17 +179,173 @@ def create_mock_id_token(email: str, sub: str, nonce: str, base_url: str, client
     signing_input = f"{header_b64}.{payload_b64}".encode()
 
     # Sign with private key using RS256 (RSA with SHA-256)
-    signature = _private_key.sign(signing_input, padding.PKCS1v15(), hashes.SHA256())
+    signature = signing_key().sign(signing_input, padding.PKCS1v15(), hashes.SHA256())
 
     # Encode signature
     signature_b64 = base64.urlsafe_b64encode(signature).decode().rstrip("=")
 
-    return f"{header_b64}.{payload_b64}.{signature_b64}"
+    token = f"{header_b64}.{payload_b64}.{signature_b64}"
+    if reuse:
+        _id_token_cache[cache_key] = (token, time.time())
+    return token
+
+
+class Faults(BaseModel):
+    """Misbehaviour of one endpoint of the mock, to simulate a slow or flaky provider."""
+
+    # Latency distribution: constant, uniform (between 0 and 2 * mean), exponential or normal
+    latency: Literal["constant", "uniform", "exponential", "normal"] = "constant"
+    # Mean latency in seconds
+    latency_mean: float = 0
+    # Standard deviation of the latency, for the normal distribution
+    latency_stddev: float = 0
+    # Probability of a server error
+    error_rate: float = 0
+    # Status code of server errors
+    error_status: int = 503
+    # Probability of an invalid_grant error (token endpoint only)
+    invalid_grant_rate: float = 0
+    # Probability of a 429 Too Many Requests response
+    rate_limit_rate: float = 0
+    # Retry-After header of 429 responses, in seconds
+    retry_after: int = 1
+
+    def sample_latency(self, rng):
+        match self.latency:
+            case "constant":
+                return self.latency_mean
+            case "uniform":
+                return rng.uniform(0, 2 * self.latency_mean)
+            case "exponential":
+                return rng.expovariate(1 / self.latency_mean) if self.latency_mean else 0
+            case "normal":
+                return max(0, rng.gauss(self.latency_mean, self.latency_stddev))
+
+
+class FaultSettings(BaseModel):
+    # Faults for each endpoint, by name (see FAULT_ENDPOINTS)
+    endpoints: dict[str, Faults] = {}
+    # Seed for the random number generator, for reproducible runs
+    seed: Optional[int] = None
+
+
+# Names of the endpoints that faults can be injected into
+FAULT_ENDPOINTS = {
+    "/.well-known/openid-configuration": "discovery",
+    "/oauth2/auth": "auth",
+    "/oauth2/token": "token",
+    "/oauth2/revoke": "revoke",
+    "/oauth2/userinfo": "userinfo",
+    "/oauth2/certs": "certs",
+}
+
+_faults = FaultSettings()
+_faults_random = random.Random()
+
+
+@app.middleware("http")
+async def inject_faults(request: Request, call_next):
+    name = FAULT_ENDPOINTS.get(request.url.path)
+    if (faults := _faults.endpoints.get(name)) is None:
+        return await call_next(request)
+
+    if latency := faults.sample_latency(_faults_random):
+        await asyncio.sleep(latency)
+
+    roll = _faults_random.random()
+    if roll < (threshold := faults.error_rate):
+        return JSONResponse({"error": "server_error"}, status_code=faults.error_status)
+    if name == "token" and roll < (threshold := threshold + faults.invalid_grant_rate):
+        return JSONResponse(
+            {"error": "invalid_grant", "error_description": "Injected fault"}, status_code=400
+        )
+    if roll < threshold + faults.rate_limit_rate:
+        return JSONResponse(
+            {"error": "rate_limit_exceeded"},
+            status_code=429,
+            headers={"Retry-After": str(faults.retry_after)},
+        )
+    return await call_next(request)
+
+
+@app.get("/admin/faults")
+async def get_faults():
+    """Get the faults currently injected into the endpoints."""
+    return _faults
+
+
+@app.post("/admin/faults")
+async def set_faults(settings: FaultSettings):
+    """Set the faults to inject into the endpoints, replacing the current ones."""
+    global _faults
+    if unknown := set(settings.endpoints) - set(FAULT_ENDPOINTS.values()):
+        raise HTTPException(status_code=400, detail=f"Unknown endpoints: {sorted(unknown)}")
+    _faults = settings
+    if settings.seed is not None:
+        _faults_random.seed(settings.seed)
+    return _faults
+
+
+@app.delete("/admin/faults")
+async def clear_faults():
+    """Stop injecting faults."""
+    global _faults
+    _faults = FaultSettings()
+    return _faults
+
+
+# Store mock tokens for refresh and authorization codes, evicting the oldest ones
+mock_token_store = LRUCache(settings.store_size)
+mock_auth_code_store = LRUCache(settings.store_size)  # Store nonce and other data for auth codes
+mock_access_token_store = LRUCache(settings.store_size)
+_revoked_tokens = LRUCache(settings.store_size)
+_id_token_cache = LRUCache(settings.store_size)
+
+
+def issue_token(prefix: str, data: dict) -> str:
+    """Create a token or code that carries its data, so that any worker can redeem it."""
+    payload = _b64(json.dumps(data, separators=(",", ":")).encode())
+    return f"{prefix}{payload}.{uuid4().hex}"
+
+
+def lookup_token(store: dict, token: str, prefix: str) -> Optional[dict]:
+    """Find the data for a token in the store, or decode it in stateless mode."""
+    if (data := store.get(token)) is not None:
+        return data
+    if not settings.stateless or not token or not token.startswith(prefix):
+        return None
+    if token in _revoked_tokens:
+        return None
+    payload = token.removeprefix(prefix).split(".")[0]
+    try:
+        return json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    except ValueError:
+        return None
+
+
+def mock_sub(email: str) -> str:
+    """Stable user ID for an email address."""
+    return str(int(hashlib.sha256(email.encode()).hexdigest()[:12], 16))
 
 
-# Store mock tokens for refresh and authorization codes
-mock_token_store = {}
-mock_auth_code_store = {}  # Store nonce and other data for auth codes
+def issue_access_token(email: str) -> str:
+    """Create an access token for the userinfo endpoint."""
+    data = {"email": email, "sub": mock_sub(email)}
+    access_token = issue_token("AT", data)
+    mock_access_token_store[access_token] = data
+    return access_token
+
+
+def mint_refresh_token(email: str) -> str:
+    """Register a refresh token for the given identity, skipping the authorization flow."""
+    refresh_token = issue_token("RT", {"email": email, "sub": mock_sub(email)})
+    mock_token_store[refresh_token] = {
+        "email": email,
+        "sub": mock_sub(email),
+        "access_token": None,
+        "created_at": datetime.now(),
+    }
+    return refresh_token
 
 
 @app.get("/.well-known/openid-configuration")
@@ -116,6 +358,7 @@ async def openid_configuration(request: Request):
             "authorization_endpoint": f"{base_url}/oauth2/auth",
             "token_endpoint": f"{base_url}/oauth2/token",
             "userinfo_endpoint": f"{base_url}/oauth2/userinfo",
+            "revocation_endpoint": f"{base_url}/oauth2/revoke",
             "jwks_uri": f"{base_url}/oauth2/certs",
             "response_types_supported": ["code", "token", "id_token"],
             "subject_types_supported": ["public"],
@@ -148,11 +391,11 @@ async def token_endpoint(
 
     if grant_type == "authorization_code":
         # Initial token request with authorization code
-        access_token = f"AT{uuid4()}"
-        new_refresh_token = f"RT{uuid4()}"
-
         # Retrieve nonce and redirect_uri from auth code store if it exists
-        auth_code_data = mock_auth_code_store.get(code, {})
+        auth_code_data = lookup_token(mock_auth_code_store, code, AUTH_CODE_PREFIX) or {}
+        email = auth_code_data.get("email", _mock_email)
+        access_token = issue_access_token(email)
+        new_refresh_token = issue_token("RT", {"email": email, "sub": mock_sub(email)})
         nonce = auth_code_data.get("nonce")
         stored_redirect_uri = auth_code_data.get("redirect_uri")
 
@@ -168,20 +411,19 @@ async def token_endpoint(
 
         base_url = f"{request.url.scheme}://{request.url.netloc}"
         id_token = create_mock_id_token(
-            email=_mock_email, sub="123456789", nonce=nonce, base_url=base_url, client_id=client_id
+            email=email, sub=mock_sub(email), nonce=nonce, base_url=base_url, client_id=client_id
         )
 
         # Store token data for potential refresh
         mock_token_store[new_refresh_token] = {
-            "email": _mock_email,
-            "sub": "123456789",
+            "email": email,
+            "sub": mock_sub(email),
             "access_token": access_token,
             "created_at": datetime.now(),
         }
 
         # Clean up used auth code
-        if code in mock_auth_code_store:
-            del mock_auth_code_store[code]
+        mock_auth_code_store.pop(code, None)
 
         return JSONResponse(
             {
@@ -199,23 +441,28 @@ async def token_endpoint(
         if not refresh_token:
             raise HTTPException(status_code=400, detail="refresh_token required")
 
-        # Get stored user data or use defaults
-        stored_data = mock_token_store.get(
-            refresh_token, {"email": _mock_email, "sub": "123456789"}
-        )
+        stored_data = lookup_token(mock_token_store, refresh_token, "RT")
+        if stored_data is None:
+            raise HTTPException(
+                status_code=400,
+                detail={
+                    "error": "invalid_grant",
+                    "error_description": "Token has been expired or revoked.",
+                },
+            )
 
-        new_access_token = f"mock_access_token_refreshed_{int(time.time())}"
+        new_access_token = issue_access_token(stored_data["email"])
         base_url = f"{request.url.scheme}://{request.url.netloc}"
         new_id_token = create_mock_id_token(
-            email=stored_data.get("email", _mock_email),
-            sub=stored_data.get("sub", "123456789"),
+            email=stored_data["email"],
+            sub=stored_data["sub"],
             nonce="",
             base_url=base_url,
             client_id=client_id,
         )
 
         # Update stored data
-        mock_token_store[refresh_token]["access_token"] = new_access_token
+        mock_token_store[refresh_token] = {**stored_data, "access_token": new_access_token}
 
         return JSONResponse(
             {
@@ -236,22 +483,49 @@ async def token_endpoint(
         )
 
 
+@app.post("/oauth2/revoke")
+async def revoke_endpoint(token: str = Form(...)):
+    """Mock OAuth2 revocation endpoint."""
+    mock_token_store.pop(token, None)
+    if settings.stateless:
+        _revoked_tokens[token] = True
+    return JSONResponse({})
+
+
 @app.get("/oauth2/userinfo")
-async def userinfo_endpoint():
-    """Mock OAuth2 userinfo endpoint."""
-    return JSONResponse(
-        {
-            "sub": "123456789",
-            "email": _mock_email,
-            "email_verified": True,
-            "name": "Test User",
-            "given_name": "Test",
-            "family_name": "User",
-            "picture": "https://example.com/avatar.jpg",
-            "locale": "en",
-            "hd": "example.com",
-        }
+async def userinfo_endpoint(request: Request):
+    """Mock OAuth2 userinfo endpoint.
+
+    The user is identified by the access token in the Authorization header, or is
+    the email set with /set_email if there is none. Responses have an ETag and
+    If-None-Match is honoured.
+    """
+    match request.headers.get("Authorization", "").split(" ", 1):
+        case ["Bearer", access_token]:
+            data = lookup_token(mock_access_token_store, access_token, "AT")
+            if data is None:
+                raise HTTPException(status_code=401, detail={"error": "invalid_token"})
+            email, sub = data["email"], data["sub"]
+        case _:
+            email, sub = _mock_email, "123456789"
+
+    userinfo = {
+        "sub": sub,
+        "email": email,
+        "email_verified": True,
+        "name": "Test User",
+        "given_name": "Test",
+        "family_name": "User",
+        "picture": "https://example.com/avatar.jpg",
+        "locale": "en",
+        "hd": "example.com",
+    }
+    etag = (
+        '"' + hashlib.sha256(json.dumps(userinfo, sort_keys=True).encode()).hexdigest()[:16] + '"'
     )
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return JSONResponse(userinfo, headers={"ETag": etag})
 
 
 @app.get("/oauth2/auth")
@@ -263,18 +537,22 @@ async def authorize_endpoint(
     scope: str = "openid email",
     state: Optional[str] = None,
     nonce: Optional[str] = None,
+    login_hint: Optional[str] = None,
 ):
-    """Mock OAuth2 authorization endpoint."""
+    """Mock OAuth2 authorization endpoint.
+
+    The user is logged in as login_hint if it is given, otherwise as the email set
+    with /set_email, so that concurrent logins can use different identities.
+    """
     from fastapi.responses import RedirectResponse
 
-    # Always approve and redirect with mock authorization code
-    auth_code = f"mock_auth_code_{int(time.time())}"
+    email = login_hint or _mock_email
 
+    # Always approve and redirect with mock authorization code
     # Store nonce and redirect_uri with the auth code for later retrieval
-    mock_auth_code_store[auth_code] = {
-        "nonce": nonce,
-        "redirect_uri": redirect_uri,
-    }
+    auth_code_data = {"email": email, "nonce": nonce, "redirect_uri": redirect_uri}
+    auth_code = issue_token(AUTH_CODE_PREFIX, auth_code_data)
+    mock_auth_code_store[auth_code] = auth_code_data
 
     params = f"code={auth_code}"
     if state:
@@ -283,7 +561,7 @@ async def authorize_endpoint(
     # Add id_token and access_token to the response
     base_url = f"{request.url.scheme}://{request.url.netloc}"
     id_token = create_mock_id_token(
-        email=_mock_email, sub="123456789", nonce=nonce, base_url=base_url, client_id=client_id
+        email=email, sub=mock_sub(email), nonce=nonce, base_url=base_url, client_id=client_id
     )
     access_token = f"mock_access_token_{int(time.time())}"
 
@@ -297,20 +575,7 @@ async def authorize_endpoint(
 @app.get("/oauth2/certs")
 async def certs_endpoint():
     """JWKS endpoint with real public key."""
-    return JSONResponse(
-        {
-            "keys": [
-                {
-                    "kty": "RSA",
-                    "use": "sig",
-                    "kid": "mock_key_id",
-                    "n": _modulus,
-                    "e": _exponent,
-                    "alg": "RS256",
-                }
-            ]
-        }
-    )
+    return JSONResponse({"keys": [public_jwk()]})
 
 
 @app.get("/health")
@@ -343,6 +608,7 @@ async def root(request: Request):
         "endpoints": {
             "authorization": "/oauth2/auth",
             "token": "/oauth2/token",
+            "revocation": "/oauth2/revoke",
             "userinfo": "/oauth2/userinfo",
             "jwks": "/oauth2/certs",
             "openid_configuration": "/.well-known/openid-configuration",
@@ -354,3 +620,44 @@ async def root(request: Request):
             "set_email": f"curl -X POST {base_url}/set_email -d 'email=custom@example.com'",
         },
     }
+
+
+def main(argv=None):
+    import argparse
+    import tempfile
+
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run the mock OAuth2 server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--key-file", help="PEM file for the signing key, created if missing")
+    parser.add_argument("--key-size", type=int)
+    parser.add_argument("--store-size", type=int)
+    parser.add_argument("--id-token-ttl", type=float)
+    parser.add_argument("--stateless", action="store_true", default=None)
+    args = parser.parse_args(argv)
+
+    if args.workers > 1:
+        # Workers must agree on the signing key and accept each other's tokens
+        args.stateless = True
+        args.key_file = args.key_file or str(Path(tempfile.mkdtemp()) / "mock_oauth_key.pem")
+    for name in MockSettings.model_fields:
+        if (value := getattr(args, name)) is not None:
+            os.environ[f"MOCK_OAUTH_{name.upper()}"] = str(value)
+    configure(**MockSettings.from_env().model_dump(exclude_unset=True))
+    if settings.key_file:
+        # Create the key file before the workers start, so they do not race for it
+        signing_key()
+
+    uvicorn.run(
+        "easy_oauth.testing.oauth_mock:app" if args.workers > 1 else app,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+    )
+
+
+if __name__ == "__main__":
+    main()
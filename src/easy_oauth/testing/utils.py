@@ -1,9 +1,14 @@
+import itertools
+import socket
 import threading
 import time
-from contextlib import contextmanager, nullcontext
+from contextlib import asynccontextmanager, contextmanager, nullcontext
 from dataclasses import dataclass
-from random import randint
+from datetime import datetime, timedelta
+from http.cookiejar import CookieJar, DefaultCookiePolicy
 
+import anyio
+import anyio.from_thread
 import httpx
 import uvicorn
 
@@ -70,15 +75,149 @@ def create_endpoint(app, host, port, wrap=nullcontext):
     server_thread.stop()
 
 
+def free_port():
+    # Random ports may collide with the ephemeral ports of client connections
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# In-process apps are only reached through their netloc, so their ports need
+# to be distinct, but no socket has to be bound to them
+inprocess_ports = itertools.count(50000)
+
+
+@asynccontextmanager
+async def asgi_lifespan(app):
+    """Run the startup and shutdown of an ASGI app around the block, like a server would.
+
+    Yields the lifespan state, which must be copied into the scope of each request.
+    """
+    state = {}
+    to_app, app_receive = anyio.create_memory_object_stream(1)
+    app_send, from_app = anyio.create_memory_object_stream(1)
+    scope = {"type": "lifespan", "asgi": {"version": "3.0"}, "state": state}
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(app, scope, app_receive.receive, app_send.send)
+        await to_app.send({"type": "lifespan.startup"})
+        if (message := await from_app.receive())["type"] == "lifespan.startup.failed":
+            raise RuntimeError(f"App failed to start: {message.get('message', '')}")
+        try:
+            yield state
+        finally:
+            await to_app.send({"type": "lifespan.shutdown"})
+            if (message := await from_app.receive())["type"] == "lifespan.shutdown.failed":
+                raise RuntimeError(f"App failed to shut down: {message.get('message', '')}")
+
+
+class InProcessTransport(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    """httpx transport that routes requests to ASGI apps by host and port, without sockets.
+
+    The apps' lifespans and the synchronous requests are run on an event loop in a
+    background thread.
+    """
+
+    def __init__(self):
+        self.apps = {}
+        self._lifespans = {}
+        self._portal_cm = None
+        self._portal = None
+        self._portal_thread = None
+
+    @property
+    def portal(self):
+        if self._portal is None:
+            self._portal_cm = anyio.from_thread.start_blocking_portal()
+            self._portal = self._portal_cm.__enter__()
+            self._portal_thread = self._portal.call(threading.current_thread)
+        return self._portal
+
+    def mount(self, netloc, app):
+        """Start the app's lifespan and route the requests to netloc to it."""
+        lifespan = self.portal.wrap_async_context_manager(asgi_lifespan(app))
+        state = lifespan.__enter__()
+        self._lifespans[netloc] = lifespan
+
+        async def app_with_state(scope, receive, send):
+            await app({**scope, "state": state.copy()}, receive, send)
+
+        self.apps[netloc] = httpx.ASGITransport(app=app_with_state)
+
+    def unmount(self, netloc):
+        """Stop routing requests to netloc and shut its app down."""
+        self.apps.pop(netloc, None)
+        if (lifespan := self._lifespans.pop(netloc, None)) is not None:
+            lifespan.__exit__(None, None, None)
+
+    async def handle_async_request(self, request):
+        netloc = request.url.netloc.decode()
+        if (transport := self.apps.get(netloc)) is None:
+            raise httpx.ConnectError(f"No in-process app at {netloc}", request=request)
+        return await transport.handle_async_request(request)
+
+    async def _handle_buffered(self, request):
+        request = httpx.Request(
+            request.method,
+            request.url,
+            headers=request.headers,
+            content=request.read(),
+            extensions=request.extensions,
+        )
+        response = await self.handle_async_request(request)
+        content = b"".join([chunk async for chunk in response.stream])
+        return httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            content=content,
+            extensions=response.extensions,
+        )
+
+    def handle_request(self, request):
+        portal = self.portal
+        if threading.current_thread() is self._portal_thread:
+            # Synchronous request made by an app that is itself running in the portal,
+            # e.g. the OAuthManager fetching the server metadata
+            with anyio.from_thread.start_blocking_portal() as portal:
+                return portal.call(self._handle_buffered, request)
+        return portal.call(self._handle_buffered, request)
+
+    def close(self):
+        # Clients close their transport when they are closed, but this one is shared
+        pass
+
+    async def aclose(self):
+        pass
+
+    def shutdown(self):
+        if self._portal_cm is not None:
+            self._portal_cm.__exit__(None, None, None)
+            self._portal_cm = self._portal = self._portal_thread = None
+
+
 class BaseServer:
-    def __init__(self, app, host, port, wrap=nullcontext):
+    def __init__(self, app, host, port, wrap=nullcontext, inprocess=False, transport=None):
         self.app = app
         self.host = host
-        self.port = port or (30000 + randint(1, 9999))
+        self.port = port or (next(inprocess_ports) if inprocess else free_port())
         self.wrap = wrap
         self.base_url = None
+        self.inprocess = inprocess
+        self._owns_transport = inprocess and transport is None
+        self.transport = (transport or InProcessTransport()) if inprocess else None
+        self._thread = None
+
+    def http_client(self, **kwargs):
+        """Create a httpx.Client that can reach this server."""
+        return httpx.Client(transport=self.transport, **kwargs)
 
     def __enter__(self):
+        if self.inprocess:
+            self._wrap = self.wrap()
+            self._wrap.__enter__()
+            self.transport.mount(f"{self.host}:{self.port}", self.app)
+            self.base_url = f"http://{self.host}:{self.port}"
+            return self
+
         # Start server in background thread
         server_thread = ServerThread(app=self.app, host=self.host, port=self.port, wrap=self.wrap)
         server_thread.start()
@@ -106,46 +245,210 @@ class BaseServer:
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.inprocess:
+            self.transport.unmount(f"{self.host}:{self.port}")
+            if self._owns_transport:
+                self.transport.shutdown()
+            self._wrap.__exit__(exc_type, exc_val, exc_tb)
         if self._thread:
             self._thread.stop()
 
 
 class OAuthMock(BaseServer):
-    def __init__(self, host="127.0.0.1", port=29313):
+    def __init__(self, host="127.0.0.1", port=29313, inprocess=False):
         from .oauth_mock import app
 
-        super().__init__(app=app, host=host, port=port)
+        super().__init__(app=app, host=host, port=port, inprocess=inprocess)
 
     def set_email(self, email: str):
-        response = httpx.post(f"{self.base_url}/set_email", data={"email": email})
+        with self.http_client() as client:
+            response = client.post(f"{self.base_url}/set_email", data={"email": email})
+        response.raise_for_status()
+        return response.json()
+
+    def set_faults(self, seed=None, **endpoints):
+        """Inject faults into the mock's endpoints, replacing the current ones.
+
+        Each keyword argument is the name of an endpoint (discovery, auth, token,
+        revoke, userinfo or certs) and its value is a dict with the fields of
+        oauth_mock.Faults, e.g. ``set_faults(token={"error_rate": 0.1})``.
+        """
+        with self.http_client() as client:
+            response = client.post(
+                f"{self.base_url}/admin/faults", json={"endpoints": endpoints, "seed": seed}
+            )
+        response.raise_for_status()
+        return response.json()
+
+    def clear_faults(self):
+        with self.http_client() as client:
+            response = client.delete(f"{self.base_url}/admin/faults")
         response.raise_for_status()
         return response.json()
 
+    @contextmanager
+    def faults(self, seed=None, **endpoints):
+        """Inject faults into the mock's endpoints for the duration of a with block."""
+        self.set_faults(seed, **endpoints)
+        try:
+            yield
+        finally:
+            self.clear_faults()
+
 
 class AppTester(BaseServer):
-    def __init__(self, app, oauth_mock: OAuthMock, host="127.0.0.1", port=None, wrap=nullcontext):
-        super().__init__(app=app, host=host, port=port, wrap=wrap)
+    """Run an app that uses OAuthManager against an OAuthMock.
+
+    If the OAuthMock is in-process, the app is as well, and the app's requests
+    to the mock are routed in memory.
+    """
+
+    def __init__(
+        self,
+        app,
+        oauth_mock: OAuthMock,
+        host="127.0.0.1",
+        port=None,
+        wrap=nullcontext,
+        mint_tokens=False,
+        cache_clients=False,
+    ):
+        super().__init__(
+            app=app,
+            host=host,
+            port=port,
+            wrap=wrap,
+            inprocess=oauth_mock.inprocess,
+            transport=oauth_mock.transport,
+        )
         self.oauth_mock = oauth_mock
+        self.mint_tokens = mint_tokens
+        self.cache_clients = cache_clients
+        self._clients = {}
+        self._session = None
+
+    @property
+    def manager(self):
+        """The OAuthManager installed on the app, if it can be found."""
+        return getattr(getattr(self.app, "state", None), "easy_oauth", None)
+
+    def __enter__(self):
+        super().__enter__()
+        if self.inprocess and self.manager:
+            self.manager.set_transport(self.transport)
+        return self
 
     def set_email(self, email):
         return self.oauth_mock.set_email(email)
 
-    def client(self, email=None, prefix=""):
+    def mint_token(self, email):
+        """Create a valid token for email directly, without going through the OAuth flow.
+
+        The refresh token is registered with the mock, so the app can still refresh
+        it, and the identity is put in the manager's token cache.
+        """
+        from ..structs import UserInfo
+        from .oauth_mock import mint_refresh_token, mock_sub
+
+        manager = self.manager
+        rtoken = mint_refresh_token(email)
+        user = UserInfo(email=email, sub=mock_sub(email))
+        manager.token_cache[rtoken] = (user, None, datetime.now() + timedelta(hours=1))
+        return manager.secrets_serializer.dumps(rtoken)
+
+    def fetch_token(self, email, prefix=""):
+        """Get a token for email through the /token route, like a user would."""
+        with self.http_client(follow_redirects=True) as client:
+            response = client.get(f"{self.base_url}{prefix}/token", params={"login_hint": email})
+        assert response.status_code == 200
+        return response.json()["refresh_token"]
+
+    def client(self, email=None, prefix="", mint=None, cache=None):
+        """Create a TokenInteractor authenticated as email (or a guest, if email is None).
+
+        Arguments:
+            mint: Whether to mint the token directly rather than going through the
+                OAuth flow. Defaults to the tester's mint_tokens setting. Minting is
+                only possible if the OAuthManager can be found on the app.
+            cache: Whether to reuse the client previously created for the same
+                email. Defaults to the tester's cache_clients setting.
+        """
+        cache = self.cache_clients if cache is None else cache
+        if cache and (email, prefix) in self._clients:
+            return self._clients[email, prefix]
+        token = self.get_token(email, prefix, mint)
+        client = TokenInteractor(self.base_url, email, token, client=self.session)
+        if cache:
+            self._clients[email, prefix] = client
+        return client
+
+    def clear_clients(self):
+        """Forget the clients cached by client(), e.g. between tests sharing this tester."""
+        self._clients.clear()
+
+    def revoke_token(self, email=None, prefix=""):
+        """Revoke the token of the cached client for email, and forget that client.
+
+        The next call to client() for email then gets a new token.
+        """
+        client = self._clients.pop((email, prefix), None)
+        if client is not None and client.token is not None:
+            client.post(f"{prefix}/revoke")
+
+    def async_client(self, email=None, prefix="", mint=None, client=None):
+        """Create an AsyncTokenInteractor authenticated as email.
+
+        Arguments:
+            mint: See client().
+            client: A httpx.AsyncClient to send the requests through, e.g. one
+                created with async_session() and shared by many interactors. If
+                None, the interactor creates its own, which is closed by aclose().
+        """
+        token = self.get_token(email, prefix, mint)
+        return AsyncTokenInteractor(
+            self.base_url, email, token, client=client, transport=self.transport
+        )
+
+    def get_token(self, email, prefix="", mint=None):
+        mint = self.mint_tokens if mint is None else mint
+        manager = self.manager
         if email is None:
-            token = None
+            return None
+        elif mint and manager is not None and not manager.force_user:
+            return self.mint_token(email)
         else:
-            self.set_email(email)
-            response = httpx.get(f"{self.base_url}{prefix}/token", follow_redirects=True)
-            assert response.status_code == 200
-            token = response.json()["refresh_token"]
-        return TokenInteractor(self.base_url, email, token)
+            return self.fetch_token(email, prefix)
+
+    @property
+    def session(self):
+        """Connection pool shared by the TokenInteractors, closed with the tester."""
+        if self._session is None:
+            self._session = httpx.Client(transport=self.transport, cookies=no_cookies())
+        return self._session
+
+    def async_session(self, **kwargs):
+        """Create a httpx.AsyncClient that can be shared by many AsyncTokenInteractors."""
+        return httpx.AsyncClient(transport=self.transport, cookies=no_cookies(), **kwargs)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        if self.inprocess and self.manager:
+            self.manager.set_transport(None)
+        super().__exit__(exc_type, exc_val, exc_tb)
 
     def __str__(self):
         return self.base_url
 
 
+def no_cookies():
+    # Interactors are authenticated by their token only, they must not share a session
+    return CookieJar(policy=DefaultCookiePolicy(allowed_domains=[]))
+
+
 @dataclass
-class TokenInteractor:
+class BaseInteractor:
     root: str
     email: str
     token: str | None
@@ -164,14 +467,76 @@ class TokenInteractor:
             )
         return response
 
-    def get(self, endpoint, expect=None, **data):
-        response = httpx.get(f"{self.root}{endpoint}", headers=self.headers, params=data)
+
+@dataclass
+class TokenInteractor(BaseInteractor):
+    client: httpx.Client = None
+    transport: httpx.BaseTransport = None
+
+    def __post_init__(self):
+        super().__post_init__()
+        self._owns_client = self.client is None
+        if self._owns_client:
+            self.client = httpx.Client(transport=self.transport, cookies=no_cookies())
+
+    def close(self):
+        if self._owns_client:
+            self.client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def request(self, method, endpoint, expect=None, **kwargs):
+        response = self.client.request(
+            method, f"{self.root}{endpoint}", headers=self.headers, **kwargs
+        )
         return self.expect(response, expect)
 
+    def get(self, endpoint, expect=None, **data):
+        return self.request("GET", endpoint, expect, params=data)
+
     def post(self, endpoint, expect=None, **data):
-        response = httpx.post(f"{self.root}{endpoint}", headers=self.headers, json=data)
-        return self.expect(response, expect)
+        return self.request("POST", endpoint, expect, json=data)
 
     def delete(self, endpoint, expect=None, **data):
-        response = httpx.delete(f"{self.root}{endpoint}", headers=self.headers, json=data)
+        return self.request("DELETE", endpoint, expect, json=data)
+
+
+@dataclass
+class AsyncTokenInteractor(BaseInteractor):
+    client: httpx.AsyncClient = None
+    transport: httpx.AsyncBaseTransport = None
+
+    def __post_init__(self):
+        super().__post_init__()
+        self._owns_client = self.client is None
+        if self._owns_client:
+            self.client = httpx.AsyncClient(transport=self.transport, cookies=no_cookies())
+
+    async def aclose(self):
+        if self._owns_client:
+            await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
+
+    async def request(self, method, endpoint, expect=None, **kwargs):
+        response = await self.client.request(
+            method, f"{self.root}{endpoint}", headers=self.headers, **kwargs
+        )
         return self.expect(response, expect)
+
+    async def get(self, endpoint, expect=None, **data):
+        return await self.request("GET", endpoint, expect, params=data)
+
+    async def post(self, endpoint, expect=None, **data):
+        return await self.request("POST", endpoint, expect, json=data)
+
+    async def delete(self, endpoint, expect=None, **data):
+        return await self.request("DELETE", endpoint, expect, json=data)
@@ -0,0 +1,94 @@
+"""Per-request timers, reported in a Server-Timing response header.
+
+Timers only measure anything within a request handled by ServerTimingMiddleware.
+Elsewhere, timer() returns the same no-op object as tracing.span().
+"""
+
+import time
+from contextvars import ContextVar
+
+from .tracing import NO_SPAN
+
+_timings = ContextVar("easy_oauth_timings", default=None)
+
+
+class Timer:
+    __slots__ = ("timings", "name", "start")
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        self.timings[self.name] = self.timings.get(self.name, 0) + elapsed
+        return False
+
+
+def timer(name):
+    """Context manager that adds the time spent in it to the request's timing for name."""
+    timings = _timings.get()
+    if timings is None:
+        return NO_SPAN
+    return Timer(timings, name)
+
+
+def format_server_timing(timings):
+    return ", ".join(f"{name};dur={elapsed * 1000:.3f}" for name, elapsed in timings.items())
+
+
+class ServerTimingMiddleware:
+    """ASGI middleware that collects the timers of each request into a Server-Timing header."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        from starlette.datastructures import MutableHeaders
+
+        timings = {}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and timings:
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", format_server_timing(timings))
+            await send(message)
+
+        token = _timings.set(timings)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _timings.reset(token)
+
+
+class TimedSigner:
+    """Wrap the signer of starlette's SessionMiddleware to time session decoding."""
+
+    def __init__(self, signer):
+        self.signer = signer
+
+    def unsign(self, *args, **kwargs):
+        with timer("session"):
+            return self.signer.unsign(*args, **kwargs)
+
+    def sign(self, *args, **kwargs):
+        with timer("session"):
+            return self.signer.sign(*args, **kwargs)
+
+
+def timed_session_middleware(cls):
+    """Subclass starlette's SessionMiddleware (cls) to time session decoding and encoding."""
+
+    class TimedSessionMiddleware(cls):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.signer = TimedSigner(self.signer)
+
+    return TimedSessionMiddleware
@@ -0,0 +1,47 @@
+"""Optional tracing of the authentication and authorization paths.
+
+Spans are only created once a tracer is set with set_tracer, or with
+use_opentelemetry (which requires the opentelemetry-api package). A tracer
+is anything with OpenTelemetry's start_as_current_span(name, attributes=...)
+method. Until then, span() returns a shared object that does nothing.
+"""
+
+
+class NoSpan:
+    def set_attribute(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+_tracer = None
+
+
+def set_tracer(tracer):
+    """Create spans with tracer from now on, or stop creating them if it is None."""
+    global _tracer
+    _tracer = tracer
+
+
+def use_opentelemetry(name="easy_oauth"):  # pragma: no cover
+    """Create spans with OpenTelemetry's global tracer provider."""
+    from opentelemetry import trace
+
+    set_tracer(trace.get_tracer(name))
+
+
+def span(name, **attributes):
+    """Context manager for a span named easy_oauth.<name>, yielding the span.
+
+    Attributes are prefixed with easy_oauth. and omitted if they are None.
+    """
+    if _tracer is None:
+        return NO_SPAN
+    attributes = {f"easy_oauth.{k}": v for k, v in attributes.items() if v is not None}
+    return _tracer.start_as_current_span(f"easy_oauth.{name}", attributes=attributes)
@@ -3,7 +3,7 @@ from pathlib import Path
 
 from fastapi import Depends, FastAPI
 from fastapi.responses import JSONResponse, PlainTextResponse
-from serieux import deserialize
+from serieux import Sources, deserialize
 from starlette.requests import Request
 
 from easy_oauth.manager import OAuthManager
@@ -11,15 +11,21 @@ from easy_oauth.manager import OAuthManager
 here = Path(__file__).parent
 
 
-def make_app(config_path, tmpdir: Path = None):
+def make_app(config_path, tmpdir: Path = None, **overrides):
     app = FastAPI()
 
-    oauth = deserialize(OAuthManager, config_path)
+    oauth = deserialize(OAuthManager, Sources(config_path, overrides))
 
     if tmpdir is not None:
         dest_cap_file = Path(tmpdir) / oauth.capabilities.user_file.name
         shutil.copy(oauth.capabilities.user_file, dest_cap_file)
         oauth.capabilities.user_file = dest_cap_file
+        if oauth.capabilities.api_key_file:
+            oauth.capabilities.api_key_file = Path(tmpdir) / oauth.capabilities.api_key_file.name
+        if oauth.capabilities.group_file:
+            oauth.capabilities.group_file = Path(tmpdir) / oauth.capabilities.group_file.name
+        if oauth.capabilities.resource_file:
+            oauth.capabilities.resource_file = Path(tmpdir) / oauth.capabilities.resource_file.name
 
     oauth.install(app)
 
@@ -55,6 +61,14 @@ def make_app(config_path, tmpdir: Path = None):
     ):
         return PlainTextResponse(f"{food} was baked by {email}")
 
+    @app.get("/bakery/{bakery_id}/bake")
+    async def route_bakery(
+        request: Request,
+        bakery_id: str,
+        email: str = Depends(oauth.get_email_capability("baker", resource="bakery/{bakery_id}")),
+    ):
+        return PlainTextResponse(f"{email} baked at bakery {bakery_id}")
+
     @app.get("/god")
     async def route_god(
         request: Request,
@@ -21,6 +21,19 @@ def oauth_mock():
         yield oauth
 
 
+@pytest.fixture(scope="session")
+def oauth_mock_inprocess():
+    with OAuthMock(port=OAUTH_PORT, inprocess=True) as oauth:
+        yield oauth
+
+
+@pytest.fixture
+def app_inprocess(tmpdir, oauth_mock_inprocess):
+    app = make_app(Path(here / "appconfig.yaml"), tmpdir)
+    with AppTester(app, oauth_mock_inprocess) as appt:
+        yield appt
+
+
 @pytest.fixture(scope="session")
 def app(oauth_mock):
     app = make_app(Path(here / "appconfig.yaml"))
@@ -59,3 +72,20 @@ def app_default_caps(tmpdir, oauth_mock):
     app = make_app(Path(here / "defaultcaps.yaml"), tmpdir)
     with AppTester(app, oauth_mock) as appt:
         yield appt
+
+
+@pytest.fixture
+def app_rate_limited(tmpdir, oauth_mock):
+    sources = Sources(
+        Path(here / "appconfig.yaml"),
+        {
+            "rate_limits": {
+                "login": {"rate": 0.01, "burst": 2},
+                "manage": {"rate": 0.01, "burst": 3},
+                "refresh": {"rate": 0.01, "burst": 1},
+            }
+        },
+    )
+    app = make_app(sources, tmpdir)
+    with AppTester(app, oauth_mock) as appt:
+        yield appt
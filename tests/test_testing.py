@@ -0,0 +1,379 @@
+import asyncio
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+import httpx
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+from easy_oauth.testing import oauth_mock, utils
+from easy_oauth.testing.loadgen import LoadProfile, LoadReport, main, run_load
+from easy_oauth.testing.utils import AppTester, OAuthMock, TokenInteractor
+
+from .app import make_app
+
+here = Path(__file__).parent
+
+loadgen_app = make_app(Path(here / "appconfig.yaml"))
+
+
+def test_login(app_inprocess):
+    app_inprocess.set_email("test@example.com")
+    with app_inprocess.http_client(follow_redirects=True) as client:
+        assert client.get(f"{app_inprocess}/hello").text == "Hello, None!"
+        client.get(f"{app_inprocess}/login")
+        assert client.get(f"{app_inprocess}/hello").text == "Hello, test@example.com!"
+
+
+def test_capabilities(app_inprocess):
+    boss = app_inprocess.client("boss@corleone.com")
+    assert boss.get("/murder", target="Sonny").text == "Sonny was murdered by boss@corleone.com"
+    boss.get("/bake", food="bread", expect=403)
+    app_inprocess.client().get("/murder", target="Sonny", expect=401)
+
+
+def test_manage(app_inprocess):
+    admin = app_inprocess.client("admin@admin.admin")
+    wiggum = app_inprocess.client("wiggum@springfield.us")
+    wiggum.get("/murder", target="Homer", expect=403)
+    admin.post("/manage_capabilities/add", email=wiggum.email, capability="mafia")
+    wiggum.get("/murder", target="Homer")
+
+
+def test_no_sockets(app_inprocess):
+    # The app is not listening on its port
+    with pytest.raises(httpx.ConnectError):
+        httpx.get(f"{app_inprocess}/hello")
+
+
+def test_unmounted(app_inprocess):
+    with app_inprocess.http_client() as client:
+        with pytest.raises(httpx.ConnectError):
+            client.get("http://127.0.0.1:1/hello")
+
+
+def test_standalone(tmpdir):
+    with OAuthMock(inprocess=True) as oauth_mock:
+        app = make_app(Path(here / "appconfig.yaml"), tmpdir)
+        with AppTester(app, oauth_mock) as appt:
+            assert appt.manager.transport is oauth_mock.transport
+            appt.client("boss@corleone.com").get("/murder", target="Sonny")
+        assert appt.manager.transport is None
+        assert oauth_mock.transport.apps
+    assert not oauth_mock.transport.apps
+
+
+def test_inprocess_lifespan(monkeypatch):
+    # No socket is bound to pick the ports of in-process apps
+    monkeypatch.setattr(utils, "free_port", None)
+    events = []
+
+    @asynccontextmanager
+    async def lifespan(app):
+        events.append("startup")
+        yield {"greeting": "Hello"}
+        events.append("shutdown")
+
+    async def hello(request):
+        return PlainTextResponse(request.state.greeting)
+
+    app = Starlette(routes=[Route("/hello", hello)], lifespan=lifespan)
+    with OAuthMock(inprocess=True) as oauth_mock:
+        with AppTester(app, oauth_mock) as appt:
+            assert events == ["startup"]
+            assert appt.port != oauth_mock.port
+            assert appt.client().get("/hello").text == "Hello"
+        assert events == ["startup", "shutdown"]
+
+
+@pytest.fixture
+def app_cached(tmpdir, oauth_mock_inprocess):
+    app = make_app(Path(here / "appconfig.yaml"), tmpdir)
+    with AppTester(app, oauth_mock_inprocess, mint_tokens=True, cache_clients=True) as appt:
+        yield appt
+
+
+def test_default_client(app_inprocess):
+    manager = app_inprocess.manager
+    boss = app_inprocess.client("boss@corleone.com")
+    # Tokens go through the /token route and clients are not reused by default
+    assert manager.secrets_serializer.loads(boss.token) in oauth_mock.mock_token_store
+    assert app_inprocess.client("boss@corleone.com") is not boss
+    boss.get("/murder", target="Sonny")
+
+
+def test_minted_client(app_cached):
+    boss = app_cached.client("boss@corleone.com")
+    assert boss.get("/murder", target="Sonny").text == "Sonny was murdered by boss@corleone.com"
+    # Clients are cached per email
+    assert app_cached.client("boss@corleone.com") is boss
+    assert app_cached.client("boss@corleone.com", cache=False) is not boss
+
+
+def test_revoke_cached_client(app_cached):
+    boss = app_cached.client("boss@corleone.com")
+    app_cached.revoke_token("boss@corleone.com")
+    boss.get("/murder", target="Sonny", expect=401)
+    # The next client gets a new token
+    new_boss = app_cached.client("boss@corleone.com")
+    assert new_boss is not boss
+    new_boss.get("/murder", target="Sonny")
+    # Guests and clients that were never created have nothing to revoke
+    app_cached.client()
+    app_cached.revoke_token(None)
+    app_cached.revoke_token("nobody@example.com")
+
+    app_cached.clear_clients()
+    assert app_cached.client("boss@corleone.com") is not new_boss
+
+
+def test_minted_token_refresh(app_inprocess):
+    boss = app_inprocess.client("boss@corleone.com", mint=True)
+    # The minted token is known to the mock, so the app can refresh it
+    app_inprocess.manager.token_cache.clear()
+    boss.get("/murder", target="Sonny")
+
+
+def test_async_clients(app_inprocess):
+    emails = ["boss@corleone.com", "paul.baguette@corleone.com", "wiggum@springfield.us"]
+
+    async def run():
+        async with app_inprocess.async_session() as session:
+            users = [app_inprocess.async_client(email, client=session) for email in emails]
+            responses = await asyncio.gather(
+                *[u.get("/murder", target="Sonny", expect=None) for u in users[:2]],
+                users[2].get("/murder", target="Sonny", expect=403),
+                *[u.get("/hello") for u in users],
+            )
+        assert [r.text for r in responses[3:]] == [f"Hello, {email}!" for email in emails]
+
+    asyncio.run(run())
+
+
+def test_async_client_owned(app):
+    async def run():
+        async with app.async_client("boss@corleone.com") as boss:
+            await boss.post("/manage_capabilities/add", expect=403)
+            await boss.delete("/hello", expect=405)
+        assert boss.client.is_closed
+
+    asyncio.run(run())
+
+
+def test_pooled_client(app):
+    guest = app.client()
+    boss = app.client("boss@corleone.com")
+    assert boss.client is guest.client
+    boss.get("/hello")
+    # The Bearer session cookie is not shared with other interactors
+    assert guest.get("/hello").text == "Hello, None!"
+
+    with TokenInteractor(app.base_url, None, None) as standalone:
+        standalone.get("/hello")
+    assert standalone.client.is_closed
+
+
+def test_loadgen(app_inprocess):
+    profile = LoadProfile(
+        users=3, requests=60, concurrency=5, path="/hello", denied_path="/god", denied=1, seed=0
+    )
+    report = run_load(app_inprocess, profile)
+    assert report.total == 60
+    assert report.throughput > 0
+    assert dict(report.statuses) == {
+        "session": {200: len(report.latencies["session"])},
+        "bearer": {200: len(report.latencies["bearer"])},
+        "guest": {200: len(report.latencies["guest"])},
+        "denied": {403: len(report.latencies["denied"])},
+    }
+    assert report.percentile("bearer", 50) <= report.percentile("bearer", 99)
+    summary = report.summary()
+    assert "60 requests" in summary
+    assert "denied" in summary
+
+
+def test_loadgen_report_empty_kind():
+    report = LoadReport(
+        duration=1.0,
+        latencies={"session": [0.01], "guest": []},
+        statuses={"session": Counter({200: 1}), "guest": Counter()},
+    )
+    assert report.percentile("guest", 50) is None
+    lines = report.summary().splitlines()
+    assert lines[2].split() == ["session", "1", "10.00", "10.00", "10.00", "200:", "1"]
+    assert lines[3].split() == ["guest", "0", "-", "-", "-"]
+
+
+def test_loadgen_denied_path_required():
+    with pytest.raises(ValueError, match="denied_path"):
+        LoadProfile(denied=1)
+
+
+def test_loadgen_cli(capsys):
+    main(["--app", "tests.test_testing:loadgen_app", "--requests", "20", "--guest", "0"])
+    out = capsys.readouterr().out
+    assert "20 requests" in out
+    assert "guest" not in out
+
+
+def test_concurrent_logins(app_inprocess):
+    emails = [f"user{i}@example.com" for i in range(10)]
+
+    async def login(email):
+        async with httpx.AsyncClient(
+            transport=app_inprocess.transport, follow_redirects=True
+        ) as client:
+            await client.get(f"{app_inprocess}/login", params={"login_hint": email})
+            return (await client.get(f"{app_inprocess}/hello")).text
+
+    async def run():
+        return await asyncio.gather(*[login(email) for email in emails])
+
+    assert asyncio.run(run()) == [f"Hello, {email}!" for email in emails]
+
+
+def test_fetched_token_identity(app_inprocess):
+    app_inprocess.set_email("test@example.com")
+    user = app_inprocess.client("hubert.bonjour@courrier-chaud.fr")
+    assert user.get("/hello").text == "Hello, hubert.bonjour@courrier-chaud.fr!"
+    rtoken = app_inprocess.manager.secrets_serializer.loads(user.token)
+    assert oauth_mock.mock_token_store[rtoken]["sub"] == oauth_mock.mock_sub(user.email)
+
+
+@pytest.fixture
+def faulty_mock(tmpdir):
+    with OAuthMock(inprocess=True) as mock:
+        app = make_app(Path(here / "appconfig.yaml"), tmpdir)
+        with AppTester(app, mock) as appt:
+            yield mock, appt
+        mock.clear_faults()
+
+
+def test_fault_errors(faulty_mock):
+    mock, app = faulty_mock
+    boss = app.client("boss@corleone.com")
+    app.manager.token_cache.clear()
+    with mock.faults(token={"error_rate": 1, "error_status": 502}):
+        with pytest.raises(httpx.HTTPStatusError):
+            boss.get("/hello")
+    boss.get("/hello")
+
+
+def test_fault_revoke(faulty_mock):
+    mock, app = faulty_mock
+    for status, expected in [(400, 200), (503, 502), (429, 502)]:
+        boss = app.client("boss@corleone.com")
+        with mock.faults(revoke={"error_rate": 1, "error_status": status}):
+            boss.post("/revoke", expect=expected)
+        # The token is revoked locally in any case
+        boss.get("/hello", expect=401)
+
+
+def test_fault_invalid_grant(faulty_mock):
+    mock, app = faulty_mock
+    boss = app.client("boss@corleone.com")
+    app.manager.token_cache.clear()
+    with mock.faults(token={"invalid_grant_rate": 1}):
+        boss.get("/hello", expect=401)
+
+
+def test_fault_rate_limit(faulty_mock):
+    mock, app = faulty_mock
+    with mock.faults(userinfo={"rate_limit_rate": 1, "retry_after": 7}):
+        with mock.http_client() as client:
+            response = client.get(f"{mock.base_url}/oauth2/userinfo")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "7"
+
+
+def test_fault_rates(faulty_mock):
+    mock, app = faulty_mock
+    mock.set_faults(seed=1234, certs={"error_rate": 0.3, "rate_limit_rate": 0.3})
+    with mock.http_client() as client:
+        statuses = [client.get(f"{mock.base_url}/oauth2/certs").status_code for _ in range(200)]
+    counts = {status: statuses.count(status) for status in set(statuses)}
+    assert set(counts) == {200, 429, 503}
+    assert all(40 < count < 80 for count in counts.values())
+
+
+@pytest.mark.parametrize("latency", ["constant", "uniform", "exponential", "normal"])
+def test_fault_latency(faulty_mock, latency):
+    mock, app = faulty_mock
+    faults = {"latency": latency, "latency_mean": 0.02, "latency_stddev": 0.001}
+    settings = mock.set_faults(seed=0, discovery=faults)
+    assert settings["endpoints"]["discovery"]["latency"] == latency
+    with mock.http_client() as client:
+        start = time.perf_counter()
+        for _ in range(10):
+            client.get(f"{mock.base_url}/.well-known/openid-configuration")
+        assert time.perf_counter() - start > 0.1
+        assert client.get(f"{mock.base_url}/admin/faults").json() == settings
+
+
+def test_fault_unknown_endpoint(faulty_mock):
+    mock, app = faulty_mock
+    with pytest.raises(httpx.HTTPStatusError):
+        mock.set_faults(nonexistent={"error_rate": 1})
+
+
+@pytest.fixture
+def mock_settings():
+    previous = oauth_mock.settings.model_dump()
+    yield oauth_mock
+    oauth_mock.configure(**previous)
+
+
+def test_mock_settings_from_env():
+    settings = oauth_mock.MockSettings.from_env(
+        {"MOCK_OAUTH_STORE_SIZE": "10", "MOCK_OAUTH_STATELESS": "1"}
+    )
+    assert settings.store_size == 10
+    assert settings.stateless
+    assert settings.key_file is None
+
+
+def test_mock_bounded_stores(mock_settings):
+    mock_settings.configure(store_size=5)
+    tokens = [mock_settings.mint_refresh_token(f"user{i}@example.com") for i in range(10)]
+    assert len(mock_settings.mock_token_store) == 5
+    assert list(mock_settings.mock_token_store) == tokens[5:]
+
+
+def test_mock_key_file(mock_settings, tmpdir):
+    key_file = str(tmpdir / "key.pem")
+    mock_settings.configure(key_file=key_file, key_size=1024)
+    jwk = mock_settings.public_jwk()
+    # Another worker (or test session) loads the same key from the file
+    mock_settings.configure(key_file=None)
+    assert mock_settings.public_jwk() != jwk
+    mock_settings.configure(key_file=key_file)
+    assert mock_settings.public_jwk() == jwk
+
+
+def test_mock_id_token_cache(mock_settings):
+    args = dict(email="a@b.c", sub="1", nonce=None, base_url="http://x", client_id="y")
+    mock_settings.configure(id_token_ttl=60)
+    token = mock_settings.create_mock_id_token(**args)
+    assert mock_settings.create_mock_id_token(**args) == token
+    assert mock_settings.create_mock_id_token(**{**args, "nonce": "n"}) != token
+
+
+def test_mock_stateless(mock_settings, app_inprocess):
+    mock_settings.configure(stateless=True)
+    boss = app_inprocess.client("boss@corleone.com")
+    rtoken = app_inprocess.manager.secrets_serializer.loads(boss.token)
+    # Simulate a request landing on a worker that did not issue the token
+    mock_settings.mock_token_store.clear()
+    app_inprocess.manager.token_cache.clear()
+    assert boss.get("/hello").text == "Hello, boss@corleone.com!"
+
+    mock_settings.mock_token_store.clear()
+    app_inprocess.manager.token_cache.clear()
+    asyncio.run(app_inprocess.manager.revoke_token(rtoken))
+    assert mock_settings.lookup_token(mock_settings.mock_token_store, rtoken, "RT") is None
+    assert mock_settings.lookup_token({}, "RTgarbage!", "RT") is None
+    assert mock_settings.lookup_token({}, rtoken, "XX") is None